@@ -2,10 +2,24 @@
 "Pure-python parser intended for small Domain-Specific Languages (DSLs)."
 __version__ = "0.1"
 
-from copy import deepcopy,copy
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy
+from functools import lru_cache
+from types import MappingProxyType
 
+import importlib
+import mmap
+import multiprocessing
+import os
+import random
+import string
 import sys
 import re
+import threading
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 
 class ParseFailException(Exception):
     "Failed to parse input"
@@ -13,11 +27,147 @@ class ParseFailException(Exception):
 class ParseDefinitionException(Exception):
     "Something wrong with the grammar definition"
 
+class ParseCommitException(ParseFailException):
+    "Failed to parse after a commit point ('!') in a rule, so there is no point backtracking"
+
+@lru_cache(maxsize=None)
+def _compile(regex:str,flags:int=0,binary:bool=False) -> re.Pattern:
+    "Compile a regex once, as a bytes pattern if it will be matched against a bytes buffer"
+    if binary:
+        return re.compile(regex.encode('utf-8'),flags)
+    return re.compile(regex,flags)
+
+_REPEATS = (sre_parse.MAX_REPEAT,sre_parse.MIN_REPEAT,getattr(sre_parse,'POSSESSIVE_REPEAT',None))
+
+def _subpatterns(av):
+    "Every parsed sub-pattern in the argument of a regex construct"
+    if isinstance(av,sre_parse.SubPattern):
+        yield av
+    elif isinstance(av,(tuple,list)):
+        for item in av:
+            yield from _subpatterns(item)
+
+def _leading_boundary(parsed) -> bool:
+    "True if a \\b or \\B can be tested before the regex has matched any text"
+    for op,av in parsed:
+        if op == sre_parse.AT:
+            if av in (sre_parse.AT_BOUNDARY,sre_parse.AT_NON_BOUNDARY):
+                return True
+        elif op in (sre_parse.ASSERT,sre_parse.ASSERT_NOT):
+            pass
+        elif op in _REPEATS:
+            if _leading_boundary(av[2]):
+                return True
+            if av[0] > 0:
+                return False
+        elif op == sre_parse.BRANCH:
+            return any(_leading_boundary(branch) for branch in av[1])
+        elif op in (sre_parse.SUBPATTERN,getattr(sre_parse,'ATOMIC_GROUP',None)):
+            return _leading_boundary(av[-1])
+        else:
+            return False
+    return False
+
+@lru_cache(maxsize=None)
+def _looks_behind(pattern:re.Pattern) -> bool:
+    """
+    True if pattern can look at the text before where it starts matching - ^, \\A, a leading \\b
+    or \\B, or a lookbehind.  Those patterns are matched against the text from the current offset,
+    so that they behave as if the input started there, as it did when the input was sliced.
+    """
+    parsed = sre_parse.parse(pattern.pattern,pattern.flags)
+    if _leading_boundary(parsed):
+        return True
+    pending = [parsed]
+    while pending:
+        for op,av in pending.pop():
+            if op == sre_parse.AT and av in (sre_parse.AT_BEGINNING,sre_parse.AT_BEGINNING_LINE,sre_parse.AT_BEGINNING_STRING):
+                return True
+            if op in (sre_parse.ASSERT,sre_parse.ASSERT_NOT) and av[0] < 0:
+                return True
+            pending.extend(_subpatterns(av))
+    return False
+
+def _commit_exception(element:str,rule:str,location:'LocationTracker') -> ParseCommitException:
+    "The exception for failing to match element after the commit marker in rule"
+    return ParseCommitException(f"Failed to parse: expected {element} in {rule} at "
+                                f"{location.filename}:{location.linenumber}:{location.column}, "
+                                f"around: {location.text(location.highwatermark,200)}")
+
+def _memo_spec(pure:bool=False,depends=None):
+    """
+    Turn the pure/depends declarations for a walk() function into a memo spec:
+    None if walk() results can't be cached, otherwise a (possibly empty) tuple of
+    the context keys the result depends on.
+    """
+    if depends is not None:
+        if isinstance(depends,str):
+            return (depends,)
+        return tuple(depends)
+    if pure:
+        return ()
+    return None
+
+_MISSING = object()
+
+def _memo_key(memo:tuple,context:tuple) -> tuple:
+    "Snapshot the context values that a cached walk() result depends on"
+    if not memo:
+        return ()
+    if not context:
+        raise ParseDefinitionException(f"walk() result depends on context keys {memo} but no context was passed")
+    return tuple(context[0].get(key,_MISSING) for key in memo)
+
+def _expand_grammar_item(element:str):
+    """
+    Looks at an element in the grammar, e.g. this+, and returns the element name
+    'this', the minimum and maximum number of instances, and the separator between
+    instances along with whether a trailing separator is allowed and whether the
+    separators are kept in the list, for example:
+    'this+' => 'this',(1,None),None
+    'this*' => 'this',(0,None),None
+    'this?' => 'this',(0,1),None
+    'this' => 'this',(),None
+    'this%COMMA+' => 'this',(1,None),('COMMA',False,False)
+    'this%%COMMA*' => 'this',(0,None),('COMMA',True,False)
+    'this%[COMMA]+' => 'this',(1,None),('COMMA',False,True)
+    """
+    match = re.match('([a-zA-Z0-9_-]+)(?:(%%?)(?:\\[([a-zA-Z0-9_-]+)\\]|([a-zA-Z0-9_-]+)))?(.*)',element)
+    if not match:
+        raise ParseDefinitionException(f"Parse Error: token {element} misformed")
+    if match.group(5) == '+':
+        matches = ( 1,None )
+    elif match.group(5) == '*':
+        matches = ( 0,None )
+    elif match.group(5) == '?':
+        matches = ( 0,1 )
+    elif match.group(5) == '':
+        matches = ()
+    else:
+        raise ParseDefinitionException(f"Parse Error: token {element} misformed")
+
+    if match.group(2):
+        if matches not in ((1,None),(0,None)):
+            raise ParseDefinitionException(f"Parse Error: separated list {element} must end in + or *")
+        separator = (match.group(3) or match.group(4),match.group(2) == '%%',match.group(3) is not None)
+    else:
+        separator = None
+
+    return match.group(1),matches,separator
+
 class LocationTracker:
-    "Track current location in input stream; allow for backtracking"
-    def __init__(self, text:str, filename:str, offset:int = 0, column:int = 0, indents:int = None):
+    """
+    Track current location in input stream; allow for backtracking.
+    The input can be a str or a bytes-like buffer such as an mmap; the buffer
+    is never sliced or copied, all matching is done in place at the current offset.
+    Setting end limits the input to a region of the text, starting at offset.
+    """
+    def __init__(self, text, filename:str, offset:int = 0, column:int = 0, indents:int = None,
+                 linenumber:int = 0, end:int = None):
         self.all_text = text
+        self.binary = not isinstance(text,str)
         self.offset = offset
+        self.end = len(text) if end is None else end
         self.column = column
         self.last_indent = 0
         if indents:
@@ -26,40 +176,99 @@ class LocationTracker:
             self.indents = [0]
         self.highwatermark = 0
         self.filename = filename
-        self.linenumber = 0
+        self.linenumber = linenumber
+        # The name of the last token matched, and the offset just after it
+        self.last_token = None
+        # When sharing subtrees, every token matched so far as (token,filename,linenumber,column)
+        self.occurrences = None
+        self.occurrence_count = 0
 
-    def text(self) -> str:
-        "Simply return the text from the current offset to the end of input"
-        return self.all_text[self.offset:]
+    def text(self,offset:int = None,length:int = None) -> str:
+        """
+        Return the text from the current offset (or the given offset) to the end
+        of input, or just the first 'length' characters of it
+        """
+        if offset is None:
+            offset = self.offset
+        end = self.end if length is None else min(offset+length,self.end)
+        text = self.all_text[offset:end]
+        if self.binary:
+            return bytes(text).decode('utf-8',errors='replace')
+        return text
+
+    def at_end(self) -> bool:
+        "True if all the input has been consumed"
+        return self.offset >= self.end
+
+    def checkpoint(self) -> 'LocationTracker':
+        "Save the current location so we can backtrack to it; the input itself is shared, not copied"
+        saved = copy(self)
+        saved.indents = copy(self.indents)
+        if self.occurrences is not None:
+            saved.occurrence_count = len(self.occurrences)
+        return saved
 
-    def match(self,regex:str,tabsize:int=0,flags:int=0) -> str:
+    def match(self,regex:str,tabsize:int=0,flags:int=0):
         """
         If regex matches text, return the match and
         move up the location; otherwise raise exception.
+        The match is bytes if the input is a bytes buffer.
         """
-        match = re.match(regex,self.text(),flags)
-        if match:
-            self.offset += len(match.group())
-            newline_match = re.search('\n$',match.group())
-            if newline_match:
-                self.linenumber += 1
-                self.column = 0
+        value = self.match_optional(_compile(regex,flags,self.binary),tabsize)
+        if value is None:
+            raise ParseFailException
+        return value
+
+    def match_pattern(self,pattern:re.Pattern,tabsize:int=0):
+        "Like match(), but with a regex that has already been compiled for this input"
+        value = self.match_optional(pattern,tabsize)
+        if value is None:
+            raise ParseFailException
+        return value
+
+    def match_optional(self,pattern:re.Pattern,tabsize:int=0):
+        "Like match_pattern(), but return None instead of raising an exception if pattern doesn't match"
+        if _looks_behind(pattern):
+            # Match as if the input started at the current offset; buffers are viewed, not copied
+            if self.binary:
+                with memoryview(self.all_text)[self.offset:self.end] as view:
+                    match = pattern.match(view)
+                    value = match.group() if match else None
             else:
-                self.column += len(match.group())+(match.group().count("\t")*(tabsize-1))
-            return match.group()
+                match = pattern.match(self.all_text[self.offset:self.end])
+                value = match.group() if match else None
+            if value is None:
+                return None
+            end = self.offset+len(value)
         else:
-            raise ParseFailException
+            match = pattern.match(self.all_text,self.offset,self.end)
+            if not match:
+                return None
+            value = match.group()
+            end = match.end()
+        if self.binary and end < self.end and 0x80 <= self.all_text[end] < 0xc0:
+            # A bytes pattern such as '.' or '[^x]' stopped in the middle of a multi-byte utf-8
+            # character; the value couldn't be decoded, so treat it as no match
+            return None
+        self.offset = end
+        newline = b'\n' if self.binary else '\n'
+        last_newline = value.rfind(newline)
+        if last_newline >= 0:
+            # Matches such as multi-line comments can span several lines
+            self.linenumber += value.count(newline)
+            self.column = 0
+            value_tail = value[last_newline+1:]
+        else:
+            value_tail = value
+        self.column += len(value_tail)+(value_tail.count(b'\t' if self.binary else "\t")*(tabsize-1))
+        return value
 
     def match_bool(self,regex:str,tabsize:int=0,flags:int=0) -> bool:
         """
         If regex matches text, return True and move up
         the location; otherwise return False
         """
-        try:
-            self.match(regex,tabsize,flags)
-        except ParseFailException:
-            return False
-        return True
+        return self.match_optional(_compile(regex,flags,self.binary),tabsize) is not None
 
     def strip_trailing_whitespace(self,tabsize:int=0) -> bool:
         "Remove whitespace up to end-of-line"
@@ -92,6 +301,24 @@ class LocationTracker:
         self.last_indent = location.last_indent
         self.indents = copy(location.indents)
         self.highwatermark = location.highwatermark
+        self.last_token = location.last_token
+        if self.occurrences is not None:
+            del self.occurrences[location.occurrence_count:]
+
+class ParseState:
+    """
+    Per-call state for a single parse.  Everything that changes during a parse lives
+    here or in the LocationTracker, never on the Parser or Tokenizer, so a single
+    Parser can be used by many threads at once.
+    """
+    def __init__(self,trace:bool=False,evaluate:bool=False,context:tuple=(),shared:'SharedSubtrees'=None):
+        self.trace = trace
+        # When evaluating, walk functions are called as soon as each rule matches,
+        # with the context and the values of the children, instead of building a tree
+        self.evaluate = evaluate
+        self.context = context
+        # When sharing subtrees, identical Nodes and Tokens are replaced by the copy in this table
+        self.shared = shared
 
 class Tokenizer:
     """
@@ -104,23 +331,44 @@ class Tokenizer:
         self.indent_tokens = ()
         self.tabsize = 0
         self.inline_indents = False
+        self.frozen = False
 
-    def add_token(self,name:str,regex:str,walk:callable=None):
-        "User-visible method to add a token to the tokenizer"
-        self.tokens[name] = {'regex':regex,'walk':walk}
+    def __check_not_frozen(self):
+        "Raise an exception if the tokenizer can no longer be changed"
+        if self.frozen:
+            raise ParseDefinitionException("Tokenizer is frozen and cannot be changed")
+
+    def add_token(self,name:str,regex:str,walk:callable=None,pure:bool=False,depends=None):
+        """
+        User-visible method to add a token to the tokenizer.
+        Set pure=True if walk() always returns the same value for the same token, or
+        depends to the context keys its result depends on, to cache walk() results.
+        """
+        self.__check_not_frozen()
+        self.tokens[name] = {'regex':regex,'walk':walk,'memo':_memo_spec(pure,depends)}
 
     def add_comment_style(self,regex:str,flags:int=0):
         "User-visible method to add a regex that defines a comment style"
+        self.__check_not_frozen()
         self.comment_styles.append((regex,flags))
 
     def use_indent_tokens(self,indent_token:str,outdent_token:str,tabsize:int=0,inline_indents:bool=False):
         "User-visible method to define how indent & outdent tokens are defined"
+        self.__check_not_frozen()
         if not self.ignore_whitespace:
             raise ParseDefinitionException("Cannot use indent/outdent tokens and not ignore_whitespace")
         self.indent_tokens = (indent_token,outdent_token)
         self.tabsize = tabsize
         self.inline_indents = inline_indents
 
+    def freeze(self):
+        "Make the tokenizer immutable; any later attempt to change it raises ParseDefinitionException"
+        if self.frozen:
+            return
+        self.tokens = MappingProxyType({name:MappingProxyType(dict(token)) for name,token in self.tokens.items()})
+        self.comment_styles = tuple(self.comment_styles)
+        self.frozen = True
+
     def next_token(self,name:str,location:LocationTracker) -> 'Token':
         "Return the next token if it matches 'name'"
         self.strip_whitespace_and_comments(location)
@@ -129,33 +377,65 @@ class Tokenizer:
         token_start_linenumber = location.linenumber
         token_start_column = location.column
 
+        if self.indent_tokens:
+            token = self.indent_token(name,location,token_start_filename,token_start_linenumber,token_start_column)
+            if token:
+                location.last_token = (name,location.offset)
+                return token
+
+        value = location.match(self.tokens[name]['regex'],self.tabsize)
+        location.highwatermark = location.offset
+        location.last_token = (name,location.offset)
+        return Token(name,value,token_start_filename,token_start_linenumber,token_start_column,self.tokens[name]['walk'],self.tokens[name]['memo'])
+
+    def next_value(self,name:str,location:LocationTracker):
+        "Like next_token(), but return just the token's value without making a Token; used by evaluate()"
+        self.strip_whitespace_and_comments(location)
+        location.highwatermark = location.offset
+
+        if self.indent_tokens:
+            token = self.indent_token(name,location,location.filename,location.linenumber,location.column)
+            if token:
+                location.last_token = (name,location.offset)
+                return token.body
+
+        value = location.match(self.tokens[name]['regex'],self.tabsize)
+        location.highwatermark = location.offset
+        location.last_token = (name,location.offset)
+        return value
+
+    def indent_token(self,name:str,location:LocationTracker,token_start_filename:str,token_start_linenumber:int,token_start_column:int) -> 'Token':
+        """
+        Handle indentation before a token, once whitespace and comments have been stripped.  Returns an INDENT or OUTDENT token if that's what is
+        next and what is expected, None if the indentation doesn't change and a regular token is
+        expected, otherwise raises ParseFailException
+        """
         # Now we've stripped everything, comments and spaces, up to
         # the next real thing, so look at the indent level.  We look
         # at the level before every token, but it won't change in the same line
-        if self.indent_tokens:
-            current_indent = location.last_indent
+        current_indent = location.last_indent
 
-            if current_indent > location.indents[-1]:
-                # Indent increased
-                location.indents.append(current_indent)
-                if name == self.indent_tokens[0]:
-                    return Token(self.indent_tokens[0],current_indent,token_start_filename,token_start_linenumber,token_start_column)
-                else:
-                    raise ParseFailException("Mismatch: expecting {name} but got {self.indent_tokens[0]}")
+        if current_indent > location.indents[-1]:
+            # Indent increased
+            location.indents.append(current_indent)
+            if name == self.indent_tokens[0]:
+                return Token(self.indent_tokens[0],current_indent,token_start_filename,token_start_linenumber,token_start_column)
+            else:
+                raise ParseFailException("Mismatch: expecting {name} but got {self.indent_tokens[0]}")
 
-            elif not current_indent in location.indents:
-                raise ParseFailException("Outdent to non-matching indentation level")
+        elif not current_indent in location.indents:
+            raise ParseFailException("Outdent to non-matching indentation level")
 
-            elif current_indent < location.indents[-1]:
-                # Indent decreased
-                location.indents.pop()
-                if name == self.indent_tokens[1]:
-                    return Token(self.indent_tokens[1],current_indent,token_start_filename,token_start_linenumber,token_start_column)
-                else:
-                    raise ParseFailException("Mismatch: expecting {name} but got {self.indent_tokens[1]}")
+        elif current_indent < location.indents[-1]:
+            # Indent decreased
+            location.indents.pop()
+            if name == self.indent_tokens[1]:
+                return Token(self.indent_tokens[1],current_indent,token_start_filename,token_start_linenumber,token_start_column)
+            else:
+                raise ParseFailException("Mismatch: expecting {name} but got {self.indent_tokens[1]}")
 
         # If we are expecting an INDENT then it could be a same-line indent
-        if self.indent_tokens and name == self.indent_tokens[0] and self.inline_indents:
+        if name == self.indent_tokens[0] and self.inline_indents:
             current_indent = location.column
             location.indents.append(current_indent)
             location.last_indent = current_indent
@@ -165,9 +445,7 @@ class Tokenizer:
         if name in self.indent_tokens:
             raise ParseFailException
 
-        value = location.match(self.tokens[name]['regex'],self.tabsize)
-        location.highwatermark = location.offset
-        return Token(name,value,token_start_filename,token_start_linenumber,token_start_column,self.tokens[name]['walk'])
+        return None
 
     def strip_whitespace_and_comments(self,location:LocationTracker):
         "Repeatedly try removing whitespace and comments"
@@ -190,24 +468,49 @@ class Token:
     """
     A token in the language, generated by Tokenizer
     """
-    def __init__(self,token:str,body,filename:str,linenumber:int,column:int,walk_function:callable=None):
+    def __init__(self,token:str,body,filename:str,linenumber:int,column:int,walk_function:callable=None,memo:tuple=None):
         self.token = token
-        self.body = body
+        self._body = body
         self.filename = filename
         self.linenumber = linenumber
         self.column = column
         self.walk_function = walk_function
+        self.memo = memo
+        self._cache = None
 
     def walk(self,*context):
-        "Call the walk() function defined for this token; if no walk() defined then just return the token value"
+        """
+        Call the walk() function defined for this token; if no walk() defined then just return the token value.
+        If the walk() function was declared pure, or to depend only on some context keys, the result
+        is cached and reused until one of those context keys changes.
+        """
         if self.walk_function:
+            if self.memo is not None:
+                key = _memo_key(self.memo,context)
+                cache = self._cache
+                if cache is not None and cache[0] == key:
+                    return cache[1]
             try:
-                return self.walk_function(*context,self.body)
+                value = self.walk_function(*context,self.body)
             except TypeError as exc:
                 raise ParseDefinitionException(f"walk() function for {self.token} called with wrong number of arguments - did you forget to pass in the context?") from exc
+            if self.memo is not None:
+                self._cache = (key,value)
+            return value
         else:
             return self.body
 
+    @property
+    def body(self):
+        "The token value; tokens read from a bytes buffer are only decoded when first accessed"
+        if isinstance(self._body,bytes):
+            self._body = self._body.decode('utf-8')
+        return self._body
+
+    @body.setter
+    def body(self,value):
+        self._body = value
+
     def dump(self,indent:str=""):
         "Dump the Token contents"
         print(f"{indent}- {self.token} = \"{self.body}\"; file {self.filename}:{self.linenumber}:{self.column}")
@@ -217,21 +520,35 @@ class Node:
     """
     A node in the language grammar, also the root of a tree or sub-tree.
     """
-    def __init__(self,rule:str,walk_function:callable):
+    def __init__(self,rule:str,walk_function:callable,memo:tuple=None):
         self.rule = rule
         self.children = []
         self.walk_function = walk_function
+        self.memo = memo
+        self._cache = None
 
     def add_child(self,child:'Node'):
         "Just add a child Token or Node to the tree"
         self.children.append(child)
 
     def walk(self,*context):
-        "Call the walk() function defined for this node in the grammar."
+        """
+        Call the walk() function defined for this node in the grammar.
+        If the walk() function was declared pure, or to depend only on some context keys, the result
+        is cached and reused until one of those context keys changes.
+        """
+        if self.memo is not None:
+            key = _memo_key(self.memo,context)
+            cache = self._cache
+            if cache is not None and cache[0] == key:
+                return cache[1]
         try:
-            return self.walk_function(*context,*self.children)
+            value = self.walk_function(*context,*self.children)
         except TypeError as exc:
             raise ParseDefinitionException(f"walk() function for {self.rule} called with wrong number of arguments - did you forget to pass in the context?") from exc
+        if self.memo is not None:
+            self._cache = (key,value)
+        return value
 
     def dump(self,indent:str=""):
         "Dump the Node contents along with any children nodes"
@@ -243,106 +560,567 @@ class Node:
             else:
                 child.dump(indent+"  ")
 
+class SharedSubtrees:
+    """
+    The Nodes and Tokens built by parses with share_subtrees, so that identical subtrees are
+    only stored once.  A Token is identified by its name, value and walk() function, and a Node by
+    its rule, walk() function and the identities of its children, so the parse tree becomes a DAG.
+    Shared Tokens keep the location of the first place they were found; unless track_locations
+    is False, locations maps each Token to the locations of all of its occurrences in the last
+    input parsed with this table.  The tree returned by each parse has the table as its 'shared'.
+    """
+    def __init__(self,track_locations:bool=True):
+        self.subtrees = {}
+        self.locations = {}
+        self.track_locations = track_locations
+
+    def token(self,token:'Token') -> 'Token':
+        """
+        The shared copy of token.  It is keyed on the utf-8 encoding of the raw value, so tokens
+        from bytes input aren't decoded, and str and bytes input share tokens with the same text
+        """
+        body = token._body
+        if isinstance(body,str):
+            body = body.encode('utf-8')
+        return self.subtrees.setdefault((Token,token.token,body,token.walk_function,token.memo),token)
+
+    def node(self,node:'Node') -> 'Node':
+        """
+        The shared copy of node, whose children must already be shared; the children are
+        identified by id(), which is safe because the table keeps every one of them alive
+        """
+        children = tuple(tuple(map(id,child)) if isinstance(child,list) else id(child) for child in node.children)
+        return self.subtrees.setdefault((Node,node.rule,node.walk_function,node.memo,children),node)
+
+    def _set_locations(self,occurrences:list):
+        "Record the locations of every token occurrence from a parse"
+        locations = {}
+        for token,filename,linenumber,column in occurrences:
+            locations.setdefault(token,[]).append((filename,linenumber,column))
+        self.locations = locations
+
 class Parser:
     """
     Define a grammar and tokenizer(s) used to parse input.  Provides methods to add grammar rules and to parse input.
     """
     def __init__(self):
         self.rules = {}
-        self._trace = False
+        self.frozen = False
 
-    def __trace(self,indent:str,message:str):
+    @staticmethod
+    def __trace(state:ParseState,indent:str,message:str):
         "Print a trace message"
-        if self._trace:
+        if state.trace:
             print(f"{indent}{message}",file=sys.stderr)
 
     def add_rule(self,name:str,body,tokenizer:Tokenizer=None):
-        "User-visible method to add a rule."
+        """
+        User-visible method to add a rule.
+        Each alternative in body is a (pattern,walk) pair, optionally followed by a dict of
+        options: {'pure':True} or {'depends':[context keys]} cache walk() results for the alternative.
+        """
+        if self.frozen:
+            raise ParseDefinitionException(f"Cannot add rule \"{name}\": the grammar is frozen")
         if name in self.rules:
             raise ParseDefinitionException(f"Rule \"{name}\" multiply defined!")
-        self.rules[name] = {'body':body,'tokenizer':tokenizer}
+        alternatives = []
+        for alternative in body:
+            if len(alternative) == 2:
+                pattern,walk_function = alternative
+                options = {}
+            elif len(alternative) == 3:
+                pattern,walk_function,options = alternative
+            else:
+                raise ParseDefinitionException(f"Rule \"{name}\": alternatives must be (pattern,walk) or (pattern,walk,options)")
+            if set(options) - {'pure','depends'}:
+                raise ParseDefinitionException(f"Rule \"{name}\": unknown options {sorted(set(options) - {'pure','depends'})}")
+            alternatives.append((pattern,walk_function,_memo_spec(options.get('pure',False),options.get('depends'))))
+        self.rules[name] = {'body':alternatives,'tokenizer':tokenizer}
 
-    def parse(self,text:str,trace:bool=False,filename:str="Input") -> Node:
-        "User-visible method to parse input"
-        self._trace = trace
+    def freeze(self) -> 'Parser':
+        """
+        Make the grammar, and every tokenizer it uses, immutable.  Parsing never changes the
+        Parser, so a frozen Parser can safely be shared by any number of threads.
+        """
+        if self.frozen:
+            return self
+        rules = {}
+        for name,rule in self.rules.items():
+            if rule['tokenizer']:
+                rule['tokenizer'].freeze()
+            body = tuple((tuple(pattern),walk_function,memo) for pattern,walk_function,memo in rule['body'])
+            rules[name] = MappingProxyType({'body':body,'tokenizer':rule['tokenizer']})
+        self.rules = MappingProxyType(rules)
+        self.frozen = True
+        return self
 
+    def parse(self,text,trace:bool=False,filename:str="Input",workers:int=None,split_at:str=None,
+              share_subtrees=False) -> Node:
+        """
+        User-visible method to parse input.
+        The input is normally a str, but can also be a bytes-like buffer (bytes, mmap)
+        holding utf-8 text, in which case it is tokenized in place without decoding.
+        If workers is more than 1, the input is cut into chunks after each split_at token
+        (or at unindented lines if split_at is None) which are parsed in forked worker processes,
+        or serially if the calling process has more than one thread.
+        If share_subtrees is True or a SharedSubtrees table, identical subtrees are only built once,
+        and the table, with the locations of every token, is the returned tree's 'shared'.
+        """
+        self.__check_start()
+        if share_subtrees:
+            if workers and workers > 1:
+                raise ParseDefinitionException("share_subtrees can't be used with workers")
+            shared = SharedSubtrees() if share_subtrees is True else share_subtrees
+            tree = self.__parse_text(text,filename,ParseState(trace,shared=shared))
+            tree.shared = shared
+            return tree
+        if workers and workers > 1:
+            return self.__parse_parallel(text,trace,filename,workers,split_at)
+        return self.__parse_text(text,filename,ParseState(trace))
+
+    def evaluate(self,text,*context,trace:bool=False,filename:str="Input"):
+        """
+        User-visible method to parse input and return the value of its walk() function without building a tree.
+        Walk functions are called as each rule matches, with the context followed by the values
+        of the children rather than the Nodes and Tokens; lists of children become lists of values.
+        Values from alternatives that are abandoned while backtracking are discarded.
+        """
+        self.__check_start()
+        return self.__parse_text(text,filename,ParseState(trace,evaluate=True,context=context))
+
+    def __check_start(self):
+        "Make sure the grammar has somewhere to start parsing"
         if 'start' not in self.rules:
             raise ParseDefinitionException("There must be a special top rule named \'start\'")
         if not self.rules['start']['tokenizer']:
             raise ParseDefinitionException("\'start\' rule must specify a tokenizer")
+
+    def __parse_text(self,text,filename:str,state:ParseState):
+        "Parse all of text starting from the 'start' rule"
         location = LocationTracker(text,filename)
+        if state.shared is not None and state.shared.track_locations:
+            location.occurrences = []
         try:
-            tree = self.__parse_rule('start',location,tokenizer=self.rules['start']['tokenizer'],indent="")
+            tree = self.__parse_rule('start',location,self.rules['start']['tokenizer'],state,indent="")
+        except ParseCommitException:
+            raise
         except ParseFailException as exc:
-            raise ParseFailException(f"Failed to parse: Failed around: {location.all_text[location.highwatermark:]}") from exc
+            raise ParseFailException(f"Failed to parse: Failed around: {location.text(location.highwatermark,200)}") from exc
 
         self.rules['start']['tokenizer'].strip_whitespace_and_comments(location)
-        if location.text() != "":
-            raise ParseFailException(f"Extra input found after input: {location.text()}")
+        if not location.at_end():
+            raise ParseFailException(f"Extra input found after input: {location.text(length=200)}")
+        if location.occurrences is not None:
+            state.shared._set_locations(location.occurrences)
         return tree
 
-    def parse_file(self,filename:str,trace:bool=False) -> Node:
+    def __parse_parallel(self,text,trace:bool,filename:str,workers:int,split_at:str) -> Node:
         """
-        Parse the contents of a file.
-        Need to read in the whole file because we backtrack a lot during the parsing/tokenizing
+        Parse the 'start' rule's list of items in chunks, in a pool of worker processes.
+        Chunks that don't parse on their own are merged with the chunks after them and
+        parsed serially, so the result is always the same as a serial parse.
         """
+        start_tokenizer = self.rules['start']['tokenizer']
+        body = self.rules['start']['body']
+        if len(body) != 1 or len(body[0][0]) != 1 or not body[0][0][0].endswith(('+','*')) or '%' in body[0][0][0]:
+            raise ParseDefinitionException("Parallel parsing needs a 'start' rule with a single pattern like ['statement+']")
+        pattern,walk_function,memo = body[0]
+        if split_at is None and not start_tokenizer.indent_tokens:
+            raise ParseDefinitionException("split_at must name a token unless the 'start' tokenizer uses indent tokens")
+        if split_at is not None and split_at not in start_tokenizer.tokens:
+            raise ParseDefinitionException(f"split_at token {split_at} not defined")
 
-        with open(filename, encoding='utf-8') as input_file:
-            body = input_file.read()
+        chunks = self.__split_input(text,start_tokenizer,split_at,workers*4)
+        if len(chunks) > 1 and 'fork' in multiprocessing.get_all_start_methods() and threading.active_count() == 1:
+            # Workers are forked, so they inherit the parser and text rather than having them pickled.
+            # Forking a process with other threads running can deadlock the child, so then the chunks
+            # are all parsed serially instead
+            with ProcessPoolExecutor(workers,mp_context=multiprocessing.get_context('fork'),
+                                     initializer=_init_chunk_worker,initargs=(self,text,filename,trace,split_at)) as pool:
+                futures = [pool.submit(_parse_chunk_worker,*chunk) for chunk in chunks]
+                results = [future.result() for future in futures]
+        else:
+            results = [None]*len(chunks)
 
-        return self.parse(body,trace,filename=filename)
+        walk_functions = self._walk_functions()
+        items = []
+        index = 0
+        while index < len(chunks):
+            if results[index] is not None:
+                items.extend(_replace_walk_functions(results[index],walk_functions.__getitem__))
+                index += 1
+                continue
+            # The chunk boundaries didn't match up with the grammar, so parse serially,
+            # extending the region over the following chunks until it parses
+            start,_,linenumber,column = chunks[index]
+            end_index = index+1
+            while True:
+                try:
+                    items.extend(self._parse_chunk(text,filename,start,chunks[end_index-1][1],linenumber,column,trace,split_at))
+                    break
+                except ParseFailException:
+                    if end_index == len(chunks):
+                        raise
+                    end_index += 1
+            index = end_index
+
+        _,matches,_ = _expand_grammar_item(pattern[0])
+        if matches[0] > len(items):
+            raise ParseFailException("Failed to parse: Not enough terms match in list")
+        tree = Node('start',walk_function,memo)
+        tree.add_child(items)
+        return tree
 
     @staticmethod
-    def __expand_grammar_item(element:str):
-        """
-        Looks at an element in the grammar, e.g. this+, and returns the element name
-        'this' and the minimum and maximum number of instances, for example:
-        'this+' => 'this',(1,None)
-        'this*' => 'this',(0,None)
-        'this?' => 'this',(0,1)
-        'this' => 'this',()
-        """
-        match = re.match('([a-zA-Z0-9_-]+)(.*)',element)
-        if not match:
-            raise ParseDefinitionException(f"Parse Error: token {element} misformed")
-        if match.group(2) == '+':
-            matches = ( 1,None )
-        elif match.group(2) == '*':
-            matches = ( 0,None )
-        elif match.group(2) == '?':
-            matches = ( 0,1 )
-        elif match.group(2) == '':
-            matches = ()
-
-        return match.group(1),matches
-
-    def __parse_element(self,element:str,location:LocationTracker,tokenizer:Tokenizer,indent:str):
+    def __split_input(text,tokenizer:Tokenizer,split_at:str,count:int) -> list:
+        """
+        Cut text into about count chunks at safe boundaries: just after a split_at token, or if
+        split_at is None at the start of a line that isn't indented.
+        Returns (start,end,linenumber,column) for each chunk.
+        """
+        binary = not isinstance(text,str)
+        if split_at:
+            boundary = _compile(tokenizer.tokens[split_at]['regex'],0,binary)
+        else:
+            boundary = _compile('\n(?=[^ \t\r\n])',0,binary)
+        newline = _compile('\n',0,binary)
+        length = len(text)
+        cuts = [0]
+        for index in range(1,count):
+            match = boundary.search(text,max(length*index//count,cuts[-1]))
+            if not match:
+                break
+            if cuts[-1] < match.end() < length:
+                cuts.append(match.end())
+        cuts.append(length)
+
+        chunks = []
+        linenumber = 0
+        for previous,start,end in zip([0]+cuts,cuts,cuts[1:]):
+            linenumber += sum(1 for _ in newline.finditer(text,previous,start))
+            line_start = text.rfind(b'\n' if binary else '\n',0,start)+1
+            prefix = text[line_start:start]
+            column = len(prefix)+prefix.count(b'\t' if binary else '\t')*(tokenizer.tabsize-1)
+            chunks.append((start,end,linenumber,column))
+        return chunks
+
+    def _parse_chunk(self,text,filename:str,start:int,end:int,linenumber:int,column:int,trace:bool,split_at:str=None) -> list:
+        """
+        Parse the region of text from start to end as a list of the items in the 'start' rule.
+        A region cut after a split_at token must end with that token: the cut could have been made
+        inside a comment or another token, which can still leave a region that parses.
+        """
+        tokenizer = self.rules['start']['tokenizer']
+        element,_,_ = _expand_grammar_item(self.rules['start']['body'][0][0][0])
+        location = LocationTracker(text,filename,offset=start,column=column,linenumber=linenumber,end=end)
+        location.highwatermark = start
+        items = self.__parse_grammar_item(element+'*',location,tokenizer,ParseState(trace),indent="")
+        if split_at is not None and end < len(text) and location.last_token != (split_at,end):
+            raise ParseFailException(f"Failed to parse: chunk doesn't end with {split_at}")
+        tokenizer.strip_whitespace_and_comments(location)
+        if not location.at_end():
+            raise ParseFailException(f"Failed to parse: Failed around: {location.text(location.highwatermark,200)}")
+        return items
+
+    def _walk_functions(self) -> list:
+        "Every walk() function in the grammar, in a fixed order, so they can be referred to by index"
+        functions = []
+        tokenizers = []
+        for rule in self.rules.values():
+            functions.extend(walk_function for _,walk_function,_ in rule['body'])
+            if rule['tokenizer'] and rule['tokenizer'] not in tokenizers:
+                tokenizers.append(rule['tokenizer'])
+        for tokenizer in tokenizers:
+            functions.extend(token['walk'] for token in tokenizer.tokens.values())
+        return functions
+
+    def parse_file(self,filename:str,trace:bool=False,mode:str="text",workers:int=None,split_at:str=None,
+                   share_subtrees=False) -> Node:
+        """
+        Parse the contents of a file.
+        Need the whole file available because we backtrack a lot during the parsing/tokenizing.
+        mode="text" reads the file into a str; mode="mmap" memory-maps the file and
+        tokenizes the raw bytes in place, so a very large file is never decoded or copied.
+        workers, split_at and share_subtrees are passed on to parse().
+        """
+        if mode == "text":
+            with open(filename, encoding='utf-8') as input_file:
+                body = input_file.read()
+            return self.parse(body,trace,filename=filename,workers=workers,split_at=split_at,share_subtrees=share_subtrees)
+
+        if mode == "mmap":
+            with open(filename, 'rb') as input_file:
+                if os.fstat(input_file.fileno()).st_size == 0:
+                    # Can't mmap an empty file
+                    return self.parse(b"",trace,filename=filename,workers=workers,split_at=split_at,share_subtrees=share_subtrees)
+                with mmap.mmap(input_file.fileno(),0,access=mmap.ACCESS_READ) as body:
+                    return self.parse(body,trace,filename=filename,workers=workers,split_at=split_at,share_subtrees=share_subtrees)
+
+        raise ValueError(f"Unknown parse_file mode \"{mode}\"")
+
+    def analyze(self) -> dict:
+        """
+        Statically check the grammar for shapes that make parsing fail, loop forever or backtrack
+        heavily, without parsing any input.  Returns a dict with these entries:
+        'undefined': (rule,element) pairs where element is neither a token nor a rule
+        'unreachable': rules that can't be reached from 'start'
+        'nullable': rules that can match empty input
+        'nullable_repetitions': (rule,item) pairs where a repeated item (and its separator) can match empty input, which loops forever
+        'left_recursive': rules that can call themselves without consuming input, which recurses forever
+        'first_conflicts': (rule,i,j,tokens) where alternatives i and j can both start with one of tokens,
+            or with tokens whose regexes can match the same text, like a keyword and an identifier
+        'shadowed': (rule,j,i) where alternative j starts with all of an earlier alternative i, so never matches
+        'backtracking': estimated worst-case number of times each rule re-parses its input, per nesting level
+        """
+        if 'start' not in self.rules:
+            raise ParseDefinitionException("There must be a special top rule named \'start\'")
+        if not self.rules['start']['tokenizer']:
+            raise ParseDefinitionException("\'start\' rule must specify a tokenizer")
+
+        # A rule can be tokenized differently depending on where it is used, so analyze
+        # every (rule,tokenizer) context that can be reached from 'start'.  Each item in an
+        # alternative is (element,name,matches,kind,target,separator), where kind is 'token' or
+        # 'rule', target is the tokenizer or the rule context, and separator is an item or None.
+        undefined = set()
+        contexts = {}
+        worklist = [('start',self.rules['start']['tokenizer'])]
+
+        def resolve(rule,tokenizer,element,name,matches,separator):
+            if name in tokenizer.tokens or name in tokenizer.indent_tokens:
+                return (element,name,matches,'token',tokenizer,separator)
+            if name in self.rules:
+                subcontext = (name,self.rules[name]['tokenizer'] or tokenizer)
+                worklist.append(subcontext)
+                return (element,name,matches,'rule',subcontext,separator)
+            undefined.add((rule,element))
+            return (element,name,matches,None,None,separator)
+
+        while worklist:
+            context = worklist.pop()
+            if context in contexts:
+                continue
+            rule,tokenizer = context
+            alternatives = []
+            for pattern,_,_ in self.rules[rule]['body']:
+                items = []
+                for element in pattern:
+                    if element == '!':
+                        continue
+                    name,matches,separator = _expand_grammar_item(element)
+                    if separator:
+                        separator = resolve(rule,tokenizer,element,separator[0],(),None)
+                    items.append(resolve(rule,tokenizer,element,name,matches,separator))
+                alternatives.append(items)
+            contexts[context] = alternatives
+
+        nullable = set()
+
+        def item_nullable(item):
+            _,name,matches,kind,target,_ = item
+            if matches in ((0,None),(0,1)):
+                return True
+            if kind == 'token':
+                return name not in target.indent_tokens and _compile(target.tokens[name]['regex']).match('') is not None
+            return kind == 'rule' and target in nullable
+
+        changed = True
+        while changed:
+            changed = False
+            for context,alternatives in contexts.items():
+                if context not in nullable and any(all(item_nullable(item) for item in items) for items in alternatives):
+                    nullable.add(context)
+                    changed = True
+
+        def element_nullable(item):
+            "Like item_nullable, but ignoring any modifier"
+            return item_nullable(item[:2]+((),)+item[3:])
+
+        def leading_items(items):
+            "The items that can be the first to consume input"
+            for item in items:
+                yield item
+                if not item_nullable(item):
+                    break
+
+        # First sets hold (token,tokenizer) pairs, so that the tokens' regexes can be compared
+        first = {context:set() for context in contexts}
+        changed = True
+        while changed:
+            changed = False
+            for context,alternatives in contexts.items():
+                for items in alternatives:
+                    for _,name,_,kind,target,_ in leading_items(items):
+                        new = {(name,target)} if kind == 'token' else first.get(target,set())
+                        if not new <= first[context]:
+                            first[context] |= new
+                            changed = True
+
+        def alternative_first(items):
+            tokens = set()
+            for _,name,_,kind,target,_ in leading_items(items):
+                tokens |= {(name,target)} if kind == 'token' else first.get(target,set())
+            return tokens
+
+        samples = {}
+
+        def token_samples(token):
+            "Some text matching the token's regex; none for indent tokens or regexes that can't be sampled"
+            if token not in samples:
+                name,tokenizer = token
+                samples[token] = []
+                if name in tokenizer.tokens:
+                    rng = random.Random(0)
+                    try:
+                        samples[token] = [_sample_regex(tokenizer.tokens[name]['regex'],rng) for _ in range(20)]
+                    except ParseDefinitionException:
+                        pass
+            return samples[token]
+
+        overlaps = {}
+
+        def tokens_overlap(token,other):
+            "True if the same input can start either token, so the parser may have to try both"
+            if token == other:
+                return True
+            if (token,other) not in overlaps:
+                overlap = False
+                for this,that in ((token,other),(other,token)):
+                    if that[0] in that[1].tokens:
+                        pattern = _compile(that[1].tokens[that[0]]['regex'])
+                        matches = (pattern.match(sample) for sample in token_samples(this))
+                        overlap = overlap or any(match and match.end() > 0 for match in matches)
+                overlaps[(token,other)] = overlaps[(other,token)] = overlap
+            return overlaps[(token,other)]
+
+        def conflicts(tokens,others):
+            "The names of the tokens in either set that overlap a token in the other"
+            return {name for token in tokens for other in others if tokens_overlap(token,other) for name in (token[0],other[0])}
+
+        left_calls = {context:{item[4] for items in alternatives for item in leading_items(items) if item[3] == 'rule'}
+                      for context,alternatives in contexts.items()}
+
+        def left_recursive(context):
+            seen = set()
+            pending = list(left_calls[context])
+            while pending:
+                callee = pending.pop()
+                if callee == context:
+                    return True
+                if callee not in seen:
+                    seen.add(callee)
+                    pending.extend(left_calls[callee])
+            return False
+
+        factors = {}
+
+        def backtracking(context,active):
+            "Alternatives sharing a first token are all tried, and each re-parses its sub-rules"
+            if context in factors:
+                return factors[context]
+            if context in active:
+                # Recursion: counted once per nesting level
+                return 1
+            active.add(context)
+            alternatives = contexts[context]
+            firsts = [alternative_first(items) for items in alternatives]
+            local = max([sum(1 for tokens in firsts if any(tokens_overlap(token,other) for other in tokens))
+                         for token in set().union(*firsts)],default=1)
+            nested = max([backtracking(item[4],active) for items in alternatives for item in items if item[3] == 'rule'],default=1)
+            active.discard(context)
+            factors[context] = local*nested
+            return factors[context]
+
+        report = {
+            'undefined':sorted(undefined),
+            'unreachable':sorted(set(self.rules)-{rule for rule,_ in contexts}),
+            'nullable':sorted({rule for rule,_ in nullable}),
+            'nullable_repetitions':set(),
+            'left_recursive':sorted({context[0] for context in contexts if left_recursive(context)}),
+            'first_conflicts':set(),
+            'shadowed':set(),
+            'backtracking':{},
+        }
+        for context,alternatives in contexts.items():
+            rule = context[0]
+            for items in alternatives:
+                for item in items:
+                    # A separated list only loops forever if the separator can be empty too
+                    if item[2] in ((1,None),(0,None)) and item[3] and element_nullable(item) and \
+                       (item[5] is None or item_nullable(item[5])):
+                        report['nullable_repetitions'].add((rule,item[0]))
+            firsts = [alternative_first(items) for items in alternatives]
+            patterns = [list(pattern) for pattern,_,_ in self.rules[rule]['body']]
+            for i in range(len(alternatives)):
+                for j in range(i+1,len(alternatives)):
+                    overlap = conflicts(firsts[i],firsts[j])
+                    if overlap:
+                        report['first_conflicts'].add((rule,i,j,tuple(sorted(overlap))))
+                    if patterns[j][:len(patterns[i])] == patterns[i]:
+                        report['shadowed'].add((rule,j,i))
+            report['backtracking'][rule] = max(report['backtracking'].get(rule,1),backtracking(context,set()))
+        for key in ('nullable_repetitions','first_conflicts','shadowed'):
+            report[key] = sorted(report[key])
+        return report
+
+    def generate_module(self,filename:str):
+        """
+        Write a standalone recursive-descent parser for this grammar to filename, as a python module.
+        The module's parse(text,filename) function returns the same tree as parse(), but each rule is
+        compiled to its own function instead of being interpreted.  Walk functions are imported by
+        name, so they must be module-level functions rather than lambdas or nested functions.
+        """
+        self.__check_start()
+        _ModuleWriter(self).write(filename)
+
+    def __parse_element(self,element:str,location:LocationTracker,tokenizer:Tokenizer,state:ParseState,indent:str):
         """
         Parse element, which can be a terminal or a non-terminal.
         Return a Node or a Token and an updated location, or raise ParseFailException
         """
-        if element in list(tokenizer.tokens)+list(tokenizer.indent_tokens):
+        if element in tokenizer.tokens or element in tokenizer.indent_tokens:
+            if state.evaluate:
+                # Call the token's walk() function on the value directly, as Token.walk() would
+                tree = tokenizer.next_value(element,location)
+                if isinstance(tree,bytes):
+                    tree = tree.decode('utf-8')
+                walk_function = tokenizer.tokens[element]['walk'] if element in tokenizer.tokens else None
+                if walk_function:
+                    try:
+                        tree = walk_function(*state.context,tree)
+                    except TypeError as exc:
+                        raise ParseDefinitionException(f"walk() function for {element} called with wrong number of arguments - did you forget to pass in the context?") from exc
+                return tree
             tree = tokenizer.next_token(element,location)
+            if state.shared is not None:
+                shared = state.shared.token(tree)
+                if location.occurrences is not None:
+                    location.occurrences.append((shared,tree.filename,tree.linenumber,tree.column))
+                tree = shared
         elif element in self.rules:
-            tree = self.__parse_rule(element,location,tokenizer,indent)
+            tree = self.__parse_rule(element,location,tokenizer,state,indent)
         else:
             raise ParseDefinitionException(f"element {element} not defined")
         return tree
 
-    def __parse_grammar_item(self,element:str,location:LocationTracker,tokenizer:Tokenizer,indent:str):
+    def __parse_grammar_item(self,element:str,location:LocationTracker,tokenizer:Tokenizer,state:ParseState,indent:str):
         """
         Parse a grammar item, which will be a Node or Token with a possible trailing modifier (+, * or ?)
+        and possibly a separator
         """
-        elt,matches_specifiers = Parser.__expand_grammar_item(element)
+        elt,matches_specifiers,separator = _expand_grammar_item(element)
+        if separator:
+            return self.__parse_separated_list(elt,matches_specifiers,separator,location,tokenizer,state,indent)
         if not matches_specifiers:
-            return self.__parse_element(elt,location,tokenizer,indent=indent+"  ")
+            return self.__parse_element(elt,location,tokenizer,state,indent=indent+"  ")
         else:
             retval = []
             count = 0
             while True:
                 try:
-                    tree = self.__parse_element(elt,location,tokenizer,indent=indent+"  ")
+                    tree = self.__parse_element(elt,location,tokenizer,state,indent=indent+"  ")
                     retval.append(tree)
+                except ParseCommitException:
+                    raise
                 except ParseFailException as exc:
                     if matches_specifiers[0] > count:
                         raise ParseFailException("Not enough terms match in list") from exc
@@ -352,35 +1130,619 @@ class Parser:
                     break
             return retval
 
-    def __parse_rule(self,rule:str,location:LocationTracker,tokenizer:Tokenizer,indent:str=""):
+    def __parse_separated_list(self,element:str,matches_specifiers:tuple,separator:tuple,location:LocationTracker,
+                               tokenizer:Tokenizer,state:ParseState,indent:str) -> list:
+        """
+        Parse a list of elements with separators between them, in a loop rather than by recursion.
+        Returns just the elements, unless the separators are to be kept in the list as well.
+        """
+        separator,allow_trailing,keep = separator
+        retval = []
+        try:
+            retval.append(self.__parse_element(element,location,tokenizer,state,indent=indent+"  "))
+        except ParseCommitException:
+            raise
+        except ParseFailException as exc:
+            if matches_specifiers[0] > 0:
+                raise ParseFailException("Not enough terms match in list") from exc
+            return retval
+        while True:
+            before_separator = location.checkpoint()
+            try:
+                separator_tree = self.__parse_element(separator,location,tokenizer,state,indent=indent+"  ")
+            except ParseCommitException:
+                raise
+            except ParseFailException:
+                location.backtrack(before_separator)
+                break
+            after_separator = location.checkpoint() if allow_trailing else before_separator
+            try:
+                tree = self.__parse_element(element,location,tokenizer,state,indent=indent+"  ")
+            except ParseCommitException:
+                raise
+            except ParseFailException:
+                location.backtrack(after_separator)
+                if allow_trailing and keep:
+                    retval.append(separator_tree)
+                break
+            if keep:
+                retval.append(separator_tree)
+            retval.append(tree)
+        return retval
+
+    def __parse_rule(self,rule:str,location:LocationTracker,tokenizer:Tokenizer,state:ParseState,indent:str=""):
         """
         Parse an entire rule.  This is the recursive-friendly key method for Parser.
         """
         if rule not in self.rules:
             raise ParseDefinitionException("Parse error: Rule {rule} not in rules")
 
-        self.__trace(indent,f"Trying to expand {rule} with text {location.text()}")
+        if state.trace:
+            self.__trace(state,indent,f"Trying to expand {rule} with text {location.text(length=200)}")
 
         if self.rules[rule]['tokenizer']:
             tokenizer = self.rules[rule]['tokenizer']
 
-        for pattern,walk_function in self.rules[rule]['body']:
-            self.__trace(indent,f" Looking at {pattern}")
-            node = Node(rule,walk_function)
-            saved_location = deepcopy(location)
+        for pattern,walk_function,memo in self.rules[rule]['body']:
+            self.__trace(state,indent,f" Looking at {pattern}")
+            children = []
+            saved_location = location.checkpoint()
+            committed = False
             try:
                 for element in pattern:
-                    tree = self.__parse_grammar_item(element,location,tokenizer,indent=indent+"  ")
-                    self.__trace(indent,f"  Got match for {element}")
-                    node.add_child(tree)
+                    if element == '!':
+                        # Commit to this alternative: from here on a failure is a parse error
+                        # rather than a reason to backtrack, so the checkpoint isn't needed
+                        committed = True
+                        saved_location = None
+                        continue
+                    try:
+                        tree = self.__parse_grammar_item(element,location,tokenizer,state,indent=indent+"  ")
+                    except ParseCommitException:
+                        raise
+                    except ParseFailException as exc:
+                        if committed:
+                            raise _commit_exception(element,rule,location) from exc
+                        raise
+                    self.__trace(state,indent,f"  Got match for {element}")
+                    children.append(tree)
                 # Got a complete match, so we are done!
-                self.__trace(indent,f" Got a complete match for {pattern}")
+                self.__trace(state,indent,f" Got a complete match for {pattern}")
                 break
+            except ParseCommitException:
+                raise
             except ParseFailException:
-                self.__trace(indent,f" Failed a complete match for {pattern}")
+                self.__trace(state,indent,f" Failed a complete match for {pattern}")
                 location.backtrack(saved_location)
 
         else:
             raise ParseFailException(f"Could not match pattern {pattern}")
 
+        if state.evaluate:
+            try:
+                return walk_function(*state.context,*children)
+            except TypeError as exc:
+                raise ParseDefinitionException(f"walk() function for {rule} called with wrong number of arguments - did you forget to pass in the context?") from exc
+
+        node = Node(rule,walk_function,memo)
+        node.children = children
+        if state.shared is not None:
+            return state.shared.node(node)
         return node
+
+_PRINTABLE = [chr(code) for code in range(32,127)]
+
+_CATEGORY_CHARS = {
+    sre_parse.CATEGORY_DIGIT:string.digits,
+    sre_parse.CATEGORY_SPACE:' ',
+    sre_parse.CATEGORY_WORD:string.ascii_letters+string.digits+'_',
+    sre_parse.CATEGORY_NOT_DIGIT:''.join(c for c in _PRINTABLE if c not in string.digits),
+    sre_parse.CATEGORY_NOT_SPACE:''.join(c for c in _PRINTABLE if c != ' '),
+    sre_parse.CATEGORY_NOT_WORD:''.join(c for c in _PRINTABLE if not (c.isalnum() or c == '_')),
+}
+
+def _sample_regex(regex:str,rng:random.Random,max_repeat:int=4) -> str:
+    "Return a random string that matches regex; unbounded repeats are capped at max_repeat extra matches"
+    return _sample_parsed(sre_parse.parse(regex),rng,max_repeat)
+
+def _set_contains(items,char:str) -> bool:
+    "True if char is in a [...] character set"
+    for op,av in items:
+        if op == sre_parse.LITERAL and av == ord(char):
+            return True
+        if op == sre_parse.RANGE and av[0] <= ord(char) <= av[1]:
+            return True
+        if op == sre_parse.CATEGORY and char in _CATEGORY_CHARS.get(av,''):
+            return True
+    return False
+
+def _sample_set(items,rng:random.Random) -> str:
+    "Return a random character from a [...] character set"
+    if items[0][0] == sre_parse.NEGATE:
+        return rng.choice([c for c in _PRINTABLE if not _set_contains(items[1:],c)])
+    op,av = rng.choice(items)
+    if op == sre_parse.LITERAL:
+        return chr(av)
+    if op == sre_parse.RANGE:
+        return chr(rng.randint(*av))
+    if op == sre_parse.CATEGORY and av in _CATEGORY_CHARS:
+        return rng.choice(_CATEGORY_CHARS[av])
+    raise ParseDefinitionException(f"Can't generate text for regex character set item {op}")
+
+def _sample_parsed(parsed,rng:random.Random,max_repeat:int) -> str:
+    "Return a random string matching an already-parsed regex"
+    text = []
+    for op,av in parsed:
+        if op == sre_parse.LITERAL:
+            text.append(chr(av))
+        elif op == sre_parse.NOT_LITERAL:
+            text.append(rng.choice([c for c in _PRINTABLE if c != chr(av)]))
+        elif op == sre_parse.ANY:
+            text.append(rng.choice(_PRINTABLE))
+        elif op == sre_parse.IN:
+            text.append(_sample_set(av,rng))
+        elif op == sre_parse.CATEGORY and av in _CATEGORY_CHARS:
+            text.append(rng.choice(_CATEGORY_CHARS[av]))
+        elif op in (sre_parse.MAX_REPEAT,sre_parse.MIN_REPEAT,getattr(sre_parse,'POSSESSIVE_REPEAT',None)):
+            low,high,item = av
+            high = min(high,low+max_repeat) if high != sre_parse.MAXREPEAT else low+max_repeat
+            for _ in range(rng.randint(low,high)):
+                text.append(_sample_parsed(item,rng,max_repeat))
+        elif op in (sre_parse.SUBPATTERN,getattr(sre_parse,'ATOMIC_GROUP',None)):
+            text.append(_sample_parsed(av[-1],rng,max_repeat))
+        elif op == sre_parse.BRANCH:
+            text.append(_sample_parsed(rng.choice(av[1]),rng,max_repeat))
+        elif op in (sre_parse.AT,sre_parse.ASSERT,sre_parse.ASSERT_NOT):
+            # Anchors and lookarounds don't produce text; generated input is checked by parsing it
+            pass
+        else:
+            raise ParseDefinitionException(f"Can't generate text for regex construct {op}")
+    return ''.join(text)
+
+class _ModuleWriter:
+    """
+    Write the source of a standalone recursive-descent parser for a grammar; see Parser.generate_module().
+    There is one function per token and per (rule,tokenizer) combination that can be reached from 'start',
+    with the alternatives and modifiers written out in full.  Each regex is compiled the first time it
+    is matched against a str, or against bytes, so importing the module stays cheap.
+    """
+    def __init__(self,parser:'Parser'):
+        self.parser = parser
+        self.setup = []
+        self.functions = []
+        self.tokenizers = {}
+        self.walks = {}
+        self.names = {}
+        self.pending = []
+
+    def __unique(self,prefix:str,name:str) -> str:
+        "A new python identifier based on name"
+        return f"{prefix}_{re.sub('[^0-9a-zA-Z_]','_',name)}_{len(self.names)}"
+
+    def tokenizer(self,tokenizer:'Tokenizer') -> str:
+        """
+        The variable holding the generated copy of tokenizer, used for indents; a _skip function
+        with the same name suffix strips whitespace and comments the way the tokenizer does
+        """
+        if id(tokenizer) not in self.tokenizers:
+            variable = f"_tokenizer_{len(self.tokenizers)}"
+            self.tokenizers[id(tokenizer)] = variable
+            self.setup.append(f"{variable} = Tokenizer(ignore_whitespace={tokenizer.ignore_whitespace!r})")
+            for regex,flags in tokenizer.comment_styles:
+                self.setup.append(f"{variable}.add_comment_style({regex!r},{int(flags)!r})")
+            if tokenizer.indent_tokens:
+                self.setup.append(f"{variable}.use_indent_tokens({tokenizer.indent_tokens[0]!r},{tokenizer.indent_tokens[1]!r},"
+                                  f"tabsize={tokenizer.tabsize!r},inline_indents={tokenizer.inline_indents!r})")
+            self.__write_skip(tokenizer,variable.replace('_tokenizer','_skip',1))
+        return self.tokenizers[id(tokenizer)]
+
+    def __write_skip(self,tokenizer:'Tokenizer',function:str):
+        """
+        Write the function that strips whitespace and comments, as Tokenizer.strip_whitespace_and_comments()
+        does; match_optional() returns None rather than raising, so nothing raises on the common path
+        """
+        patterns = []
+        if tokenizer.ignore_whitespace:
+            patterns += [('[ \t]*\n',0,0),('[ \t]*',0,tokenizer.tabsize)]
+        patterns += [(regex,flags,tokenizer.tabsize) for regex,flags in tokenizer.comment_styles]
+        for index,(regex,flags,_) in enumerate(patterns):
+            self.setup.append(f"{function}_{index} = [None,None,{regex!r},{int(flags)!r}]")
+        lines = [f"def {function}(location):",
+                 "    binary = location.binary"]
+        for index in range(len(patterns)):
+            lines.append(f"    pattern_{index} = {function}_{index}[binary] or _compile({function}_{index},binary)")
+        lines += ["    modified = True",
+                 "    while modified:",
+                 "        modified = False"]
+        for index,(regex,flags,tabsize) in enumerate(patterns):
+            pattern = f"pattern_{index}"
+            if tokenizer.ignore_whitespace and index == 1:
+                # Spaces inside a line, which set the indent when they start it
+                lines += ["        starting_column = location.column",
+                          f"        if len(location.match_pattern({pattern},{tabsize!r})) > 0:",
+                          "            modified = True",
+                          "        if starting_column == 0:",
+                          "            location.last_indent = location.column"]
+            else:
+                if _looks_behind(_compile(regex,flags)):
+                    lines += [f"        if location.match_optional({pattern},{tabsize!r}) is not None:",
+                              "            modified = True"]
+                else:
+                    # Most calls don't match, so check that cheaply first
+                    lines += [f"        if {pattern}.match(location.all_text,location.offset,location.end) and \\",
+                              f"           location.match_optional({pattern},{tabsize!r}) is not None:",
+                              "            modified = True"]
+        self.functions += [*lines,""]
+
+    def walk(self,function:callable) -> str:
+        "The variable holding a walk function, imported by its module and qualified name"
+        if function is None:
+            return 'None'
+        if id(function) not in self.walks:
+            module = getattr(function,'__module__',None)
+            qualname = getattr(function,'__qualname__',None)
+            try:
+                if not module or not qualname or '<' in qualname:
+                    raise ImportError
+                found = importlib.import_module(module)
+                for name in qualname.split('.'):
+                    found = getattr(found,name)
+            except (ImportError,AttributeError):
+                found = None
+            if found is not function:
+                raise ParseDefinitionException(f"walk() function {function!r} can't be imported by name; "
+                                               "generated parsers need module-level walk functions")
+            variable = f"_walk_{len(self.walks)}"
+            self.walks[id(function)] = variable
+            self.setup.append(f"{variable} = _import_walk({module!r},{qualname!r})")
+        return self.walks[id(function)]
+
+    def element(self,name:str,tokenizer:'Tokenizer') -> str:
+        "The function that parses a token or rule, as the interpreter would resolve it with this tokenizer"
+        if name in tokenizer.tokens or name in tokenizer.indent_tokens:
+            key = ('token',id(tokenizer),name)
+        elif name in self.parser.rules:
+            tokenizer = self.parser.rules[name]['tokenizer'] or tokenizer
+            key = ('rule',id(tokenizer),name)
+        else:
+            key = ('undefined',name)
+        if key not in self.names:
+            function = self.__unique('_'+key[0],name)
+            self.names[key] = function
+            self.pending.append((key[0],name,tokenizer,function))
+        return self.names[key]
+
+    def write(self,filename:str):
+        "Generate the whole module and write it to filename"
+        start_tokenizer = self.parser.rules['start']['tokenizer']
+        start = self.element('start',start_tokenizer)
+        while self.pending:
+            kind,name,tokenizer,function = self.pending.pop(0)
+            if kind == 'token':
+                self.__write_token(name,tokenizer,function)
+            elif kind == 'rule':
+                self.__write_rule(name,tokenizer,function)
+            else:
+                self.functions += [f"def {function}(location):",
+                                   f"    raise ParseDefinitionException({f'element {name} not defined'!r})",""]
+        tokenizer = self.tokenizer(start_tokenizer)
+        lines = [
+            f'"Parser generated by oreo {__version__}; do not edit, regenerate it from the grammar instead."',
+            "import importlib",
+            "import re",
+            "",
+            "from oreo import LocationTracker,Node,Token,Tokenizer,ParseFailException,ParseCommitException,ParseDefinitionException",
+            "",
+            # Helpers written out here, so the module only relies on oreo's public names
+            "def _compile(patterns,binary):",
+            '    "Compile [str pattern,bytes pattern,regex,flags] for str or bytes input the first time it is needed"',
+            "    regex,flags = patterns[2],patterns[3]",
+            "    patterns[binary] = re.compile(regex.encode('utf-8') if binary else regex,flags)",
+            "    return patterns[binary]",
+            "",
+            "def _commit_exception(element,rule,location):",
+            '    "The exception for failing to match element after the commit marker in rule"',
+            '    return ParseCommitException(f"Failed to parse: expected {element} in {rule} at "',
+            '                                f"{location.filename}:{location.linenumber}:{location.column}, "',
+            '                                f"around: {location.text(location.highwatermark,200)}")',
+            "",
+            "def _import_walk(module,qualname):",
+            "    value = importlib.import_module(module)",
+            "    for name in qualname.split('.'):",
+            "        value = getattr(value,name)",
+            "    return value",
+            "",
+            *self.setup,
+            "",
+            *self.functions,
+            "def parse(text,filename='Input'):",
+            '    "Parse text, which can be a str or a bytes-like buffer, and return the parse tree"',
+            "    location = LocationTracker(text,filename)",
+            "    try:",
+            f"        tree = {start}(location)",
+            "    except ParseCommitException:",
+            "        raise",
+            "    except ParseFailException as exc:",
+            "        raise ParseFailException(f\"Failed to parse: Failed around: {location.text(location.highwatermark,200)}\") from exc",
+            f"    {tokenizer.replace('_tokenizer','_skip',1)}(location)",
+            "    if not location.at_end():",
+            "        raise ParseFailException(f\"Extra input found after input: {location.text(length=200)}\")",
+            "    return tree",
+        ]
+        with open(filename,'w',encoding='utf-8') as output_file:
+            output_file.write("\n".join(lines)+"\n")
+
+    def __write_token(self,name:str,tokenizer:'Tokenizer',function:str):
+        "Write the function that matches one token"
+        variable = self.tokenizer(tokenizer)
+        if name in tokenizer.indent_tokens:
+            self.functions += [f"def {function}(location):",f"    return {variable}.next_token({name!r},location)",""]
+            return
+        token = tokenizer.tokens[name]
+        pattern = function.replace('_token','_pattern',1)
+        self.setup.append(f"{pattern} = [None,None,{token['regex']!r},0]")
+        lines = [f"def {function}(location):",
+                 f"    {variable.replace('_tokenizer','_skip',1)}(location)",
+                 "    location.highwatermark = location.offset",
+                 "    filename,linenumber,column = location.filename,location.linenumber,location.column"]
+        if tokenizer.indent_tokens:
+            lines += [f"    token = {variable}.indent_token({name!r},location,filename,linenumber,column)",
+                      "    if token:",
+                      "        return token"]
+        lines += [f"    value = location.match_optional({pattern}[location.binary] or _compile({pattern},location.binary),{tokenizer.tabsize!r})",
+                  "    if value is None:",
+                  "        raise ParseFailException",
+                  "    location.highwatermark = location.offset",
+                  f"    return Token({name!r},value,filename,linenumber,column,{self.walk(token['walk'])},{token['memo']!r})",
+                  ""]
+        self.functions += lines
+
+    def __write_rule(self,rule:str,tokenizer:'Tokenizer',function:str):
+        "Write the function that parses one rule, trying each alternative in turn"
+        lines = [f"def {function}(location):",f"    {rule!r}"]
+        pattern = []
+        for pattern,walk_function,memo in self.parser.rules[rule]['body']:
+            lines += [f"    # {list(pattern)}",
+                      "    saved_location = location.checkpoint()",
+                      "    try:"]
+            children = []
+            committed = False
+            for element in pattern:
+                if element == '!':
+                    committed = True
+                    continue
+                child = f"child_{len(children)}"
+                children.append(child)
+                item = self.__item(element,child,tokenizer)
+                if committed:
+                    item = ["try:",*["    "+line for line in item],
+                            "except ParseCommitException:",
+                            "    raise",
+                            "except ParseFailException as exc:",
+                            f"    raise _commit_exception({element!r},{rule!r},location) from exc"]
+                lines += ["        "+line for line in item]
+            lines += [f"        node = Node({rule!r},{self.walk(walk_function)},{memo!r})",
+                      f"        node.children = [{','.join(children)}]",
+                      "        return node",
+                      "    except ParseCommitException:",
+                      "        raise",
+                      "    except ParseFailException:",
+                      "        location.backtrack(saved_location)"]
+        lines += [f"    raise ParseFailException({f'Could not match pattern {list(pattern)}'!r})",""]
+        self.functions += lines
+
+    def __item(self,element:str,child:str,tokenizer:'Tokenizer') -> list:
+        "The lines that parse one item of a pattern into the variable child"
+        name,matches,separator = _expand_grammar_item(element)
+        parse = self.element(name,tokenizer)
+        if not matches:
+            return [f"{child} = {parse}(location)"]
+        if separator:
+            separator,allow_trailing,keep = separator
+            if matches[0] > 0:
+                too_few = ["except ParseFailException as exc:",'    raise ParseFailException("Not enough terms match in list") from exc']
+            else:
+                too_few = ["except ParseFailException:","    pass"]
+            return [f"{child} = []",
+                    "try:",
+                    f"    {child}.append({parse}(location))",
+                    "except ParseCommitException:",
+                    "    raise",
+                    *too_few,
+                    "else:",
+                    "    while True:",
+                    "        before_separator = location.checkpoint()",
+                    "        try:",
+                    f"            separator_tree = {self.element(separator,tokenizer)}(location)",
+                    "        except ParseCommitException:",
+                    "            raise",
+                    "        except ParseFailException:",
+                    "            location.backtrack(before_separator)",
+                    "            break",
+                    "        after_separator = "+("location.checkpoint()" if allow_trailing else "before_separator"),
+                    "        try:",
+                    f"            tree = {parse}(location)",
+                    "        except ParseCommitException:",
+                    "            raise",
+                    "        except ParseFailException:",
+                    "            location.backtrack(after_separator)",
+                    *([f"            {child}.append(separator_tree)"] if allow_trailing and keep else []),
+                    "            break",
+                    *([f"        {child}.append(separator_tree)"] if keep else []),
+                    f"        {child}.append(tree)"]
+        lines = [f"{child} = []",
+                 "while True:",
+                 "    try:",
+                 f"        {child}.append({parse}(location))",
+                 "    except ParseCommitException:",
+                 "        raise"]
+        if matches[0] > 0:
+            lines += ["    except ParseFailException as exc:",
+                      f"        if len({child}) < {matches[0]}:",
+                      '            raise ParseFailException("Not enough terms match in list") from exc']
+        else:
+            lines += ["    except ParseFailException:"]
+        lines += ["        break"]
+        if matches[1]:
+            lines += [f"    if len({child}) == {matches[1]}:",
+                      "        break"]
+        return lines
+
+_CHUNK_WORKER = {}
+
+def _init_chunk_worker(parser:Parser,text,filename:str,trace:bool,split_at:str):
+    "Set up a worker process for Parser.parse(workers=...)"
+    _CHUNK_WORKER.update(parser=parser,text=text,filename=filename,trace=trace,split_at=split_at)
+
+def _parse_chunk_worker(start:int,end:int,linenumber:int,column:int) -> list:
+    """
+    Parse one chunk in a worker process.  Walk functions can't be pickled, so they are sent
+    back as indexes into Parser._walk_functions().  Returns None if the chunk doesn't parse.
+    """
+    parser = _CHUNK_WORKER['parser']
+    try:
+        items = parser._parse_chunk(_CHUNK_WORKER['text'],_CHUNK_WORKER['filename'],start,end,linenumber,column,
+                                    _CHUNK_WORKER['trace'],_CHUNK_WORKER['split_at'])
+    except ParseFailException:
+        return None
+    indexes = {id(function):index for index,function in enumerate(parser._walk_functions())}
+    return _replace_walk_functions(items,lambda function: indexes[id(function)])
+
+def _replace_walk_functions(trees:list,convert:callable) -> list:
+    "Replace the walk function of every Node and Token in trees with convert(walk_function)"
+    pending = list(trees)
+    while pending:
+        tree = pending.pop()
+        if isinstance(tree,list):
+            pending.extend(tree)
+            continue
+        if tree.walk_function is not None:
+            tree.walk_function = convert(tree.walk_function)
+        if isinstance(tree,Node):
+            pending.extend(tree.children)
+    return trees
+
+class Generator:
+    """
+    Generate random input that a Parser accepts, e.g. to load-test or fuzz a language.
+    Input is built by walking the grammar rules and sampling text for each token from its
+    regex; the same seed always gives the same sequence of inputs.
+    """
+    def __init__(self,parser:Parser,seed=None,max_depth:int=8,max_repeat:int=4,indent_size:int=4):
+        if 'start' not in parser.rules:
+            raise ParseDefinitionException("There must be a special top rule named \'start\'")
+        if not parser.rules['start']['tokenizer']:
+            raise ParseDefinitionException("\'start\' rule must specify a tokenizer")
+        self.parser = parser
+        self.random = random.Random(seed)
+        self.max_depth = max_depth
+        self.max_repeat = max_repeat
+        self.indent_size = indent_size
+        self.min_depths = self.__min_depths()
+
+    def __min_depths(self) -> dict:
+        "Find the smallest depth of rule nesting needed to finish each alternative of each rule"
+        depths = {}
+        changed = True
+        while changed:
+            changed = False
+            for name,rule in self.parser.rules.items():
+                for index,(pattern,_,_) in enumerate(rule['body']):
+                    depth = 1
+                    for element in pattern:
+                        if element == '!':
+                            continue
+                        item,matches,_ = _expand_grammar_item(element)
+                        if item in self.parser.rules and (not matches or matches[0] > 0):
+                            depth = max(depth,1+min((d for (r,_),d in depths.items() if r == item),default=float('inf')))
+                    if depth < depths.get((name,index),float('inf')):
+                        depths[(name,index)] = depth
+                        changed = True
+        return depths
+
+    def generate(self,size:int=None,attempts:int=100) -> str:
+        """
+        Return a random input that the parser accepts.  If size is given, repeated items in
+        the 'start' rule are repeated until the input is at least size characters long.
+        Each candidate is checked by parsing it, and discarded if the parser rejects it.
+        """
+        for _ in range(attempts):
+            output = {'tokens':[],'length':0}
+            start_tokenizer = self.parser.rules['start']['tokenizer']
+            self.__generate_rule('start',start_tokenizer,0,size,output)
+            text = self.__layout(output['tokens'],start_tokenizer)
+            try:
+                self.parser.parse(text)
+            except ParseFailException:
+                continue
+            return text
+        raise ParseFailException(f"Could not generate input the parser accepts in {attempts} attempts")
+
+    def __generate_rule(self,rule:str,tokenizer:Tokenizer,depth:int,size:int,output:dict):
+        "Append the tokens for a random expansion of rule to the output"
+        if self.parser.rules[rule]['tokenizer']:
+            tokenizer = self.parser.rules[rule]['tokenizer']
+        alternatives = list(enumerate(self.parser.rules[rule]['body']))
+        if depth >= self.max_depth:
+            shallowest = min(self.min_depths.get((rule,index),float('inf')) for index,_ in alternatives)
+            if shallowest == float('inf'):
+                raise ParseDefinitionException(f"Rule {rule} can't generate any finite input")
+            alternatives = [(index,alternative) for index,alternative in alternatives
+                            if self.min_depths.get((rule,index)) == shallowest]
+        _,(pattern,_,_) = self.random.choice(alternatives)
+
+        for element in pattern:
+            if element == '!':
+                continue
+            item,matches,separator = _expand_grammar_item(element)
+            if not matches:
+                count = 1
+            elif depth >= self.max_depth:
+                count = matches[0]
+            else:
+                high = matches[1] if matches[1] is not None else matches[0]+self.max_repeat
+                count = self.random.randint(matches[0],high)
+            index = 0
+            while index < count or (size and depth == 0 and matches and matches[1] is None and output['length'] < size):
+                if separator and index > 0:
+                    self.__generate_element(separator[0],tokenizer,depth,output)
+                self.__generate_element(item,tokenizer,depth,output)
+                index += 1
+            if separator and separator[1] and index > 0 and self.random.random() < 0.5:
+                self.__generate_element(separator[0],tokenizer,depth,output)
+
+    def __generate_element(self,element:str,tokenizer:Tokenizer,depth:int,output:dict):
+        "Append the tokens for a random instance of a token or rule to the output"
+        if element in tokenizer.indent_tokens:
+            output['tokens'].append((tokenizer,element,None))
+        elif element in tokenizer.tokens:
+            body = _sample_regex(tokenizer.tokens[element]['regex'],self.random,self.max_repeat)
+            output['tokens'].append((tokenizer,element,body))
+            output['length'] += len(body)+1
+        elif element in self.parser.rules:
+            self.__generate_rule(element,tokenizer,depth+1,None,output)
+        else:
+            raise ParseDefinitionException(f"element {element} not defined")
+
+    def __layout(self,tokens:list,start_tokenizer:Tokenizer) -> str:
+        """
+        Turn tokens into text.  Tokens are separated by a space if their tokenizer ignores whitespace;
+        INDENT and OUTDENT tokens start a new line at the next deeper or shallower indent.
+        """
+        text = []
+        level = 0
+        newline = False
+        for tokenizer,name,body in tokens:
+            if body is None:
+                level += 1 if name == tokenizer.indent_tokens[0] else -1
+                newline = True
+                continue
+            if newline:
+                text.append("\n"+" "*(self.indent_size*level))
+                newline = False
+            elif text and tokenizer.ignore_whitespace:
+                text.append(" ")
+            text.append(body)
+        if start_tokenizer.ignore_whitespace:
+            text.append("\n")
+        return ''.join(text)
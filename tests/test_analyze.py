@@ -0,0 +1,73 @@
+"""
+Test the static grammar analyzer.
+"""
+import pytest
+from oreo import Tokenizer,Parser,ParseDefinitionException
+
+@pytest.fixture(name="tokenizer")
+def fixture_tokenizer():
+    "Tokens shared by the grammars below"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','[0-9]+')
+    tok.add_token('SPACES',' *')
+    tok.add_token('PLUS','\\+')
+    tok.add_token('OPEN_PAREN','\\(')
+    tok.add_token('CLOSE_PAREN','\\)')
+    return tok
+
+def test_clean_grammar(tokenizer):
+    "A grammar with no hazards has nothing to report"
+    par = Parser()
+    par.add_rule('start',[(['term+'],lambda a: a)],tokenizer=tokenizer)
+    par.add_rule('term',[
+        (['OPEN_PAREN','term*','CLOSE_PAREN'],lambda a,b,c: b),
+        (['NUMBER'],lambda a: a),
+    ])
+    report = par.analyze()
+    for key in ('undefined','unreachable','nullable','nullable_repetitions','left_recursive','first_conflicts','shadowed'):
+        assert report[key] == []
+    assert report['backtracking'] == {'start':1,'term':1}
+
+def test_hazards(tokenizer):
+    "Each kind of hazard is reported"
+    par = Parser()
+    par.add_rule('start',[(['expr','maybe*','SPACES+'],lambda a,b,c: a)],tokenizer=tokenizer)
+    par.add_rule('expr',[
+        (['expr','PLUS','NUMBER'],lambda a,b,c: a),
+        (['NUMBER'],lambda a: a),
+        (['NUMBER','PLUS','MISSING'],lambda a,b,c: a),
+    ])
+    par.add_rule('maybe',[(['NUMBER?'],lambda a: a)])
+    par.add_rule('unused',[(['NUMBER'],lambda a: a)])
+    report = par.analyze()
+    assert report['undefined'] == [('expr','MISSING')]
+    assert report['unreachable'] == ['unused']
+    assert report['nullable'] == ['maybe']
+    assert report['nullable_repetitions'] == [('start','SPACES+'),('start','maybe*')]
+    assert report['left_recursive'] == ['expr']
+    assert ('expr',1,2,('NUMBER',)) in report['first_conflicts']
+    assert report['shadowed'] == [('expr',2,1)]
+    assert report['backtracking']['expr'] == 3
+
+def test_needs_start():
+    "The analyzer needs a start rule to work from"
+    with pytest.raises(ParseDefinitionException):
+        Parser().analyze()
+
+def test_regex_conflicts():
+    "Alternatives starting with different tokens conflict if the tokens can match the same text"
+    tok = Tokenizer()
+    tok.add_token('IF','if')
+    tok.add_token('SYMBOL','[a-zA-Z]+')
+    tok.add_token('NUMBER','[0-9]+')
+    tok.add_token('EQUALS','=')
+    par = Parser()
+    par.add_rule('start',[(['statement+'],lambda a: a)],tokenizer=tok)
+    par.add_rule('statement',[
+        (['IF','SYMBOL','statement'],lambda a,b,c: a),
+        (['SYMBOL','EQUALS','NUMBER'],lambda a,b,c: a),
+        (['NUMBER'],lambda a: a),
+    ])
+    report = par.analyze()
+    assert report['first_conflicts'] == [('statement',0,1,('IF','SYMBOL'))]
+    assert report['backtracking']['statement'] == 2
@@ -0,0 +1,198 @@
+"""
+Test generating a standalone parser module from a grammar.
+"""
+import importlib.util
+import re
+import pytest
+from oreo import Tokenizer,Parser,Node,ParseFailException,ParseCommitException,ParseDefinitionException
+
+#######################################
+# Walk functions must be importable by name for generated parsers
+
+def number(n):
+    "Value of a NUMBER"
+    return int(n)
+
+def first(a,*rest):
+    "Value of the first child"
+    return a.walk()
+
+def add(a,b,c):
+    "Add two terms"
+    return a.walk()+c.walk()
+
+def total(a):
+    "Sum a list"
+    return sum(i.walk() for i in a)
+
+def statements(a):
+    "Values of all statements"
+    return [i.walk() for i in a]
+
+def value_statement(a,b,c):
+    "Value of a value statement"
+    return b.walk()
+
+def list_statement(a,b,c,d,e):
+    "Value of a list statement"
+    return [i.walk() for i in c]
+
+def optional_statement(a,b,c):
+    "Value of an optional statement"
+    return [i.walk() for i in b]
+
+def string_statement(a,b,c):
+    "Value of a quoted string"
+    return b.walk()
+
+def join(a):
+    "Join a list of strings"
+    return ''.join(i.walk() for i in a)
+
+def hex_character(a):
+    "Character for a hex code"
+    return chr(int(a,16))
+
+def block(a,b,c,d):
+    "Sum of a block"
+    return sum(i.walk() for i in c)
+
+def make_language_parser():
+    "Grammar using most of the features of oreo"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','-?[0-9]+',number,pure=True)
+    tok.add_token('PLUS','\\+')
+    tok.add_token('COMMA',',')
+    tok.add_token('OPEN','\\[')
+    tok.add_token('CLOSE','\\]')
+    tok.add_token('VALUE','value\\b')
+    tok.add_token('LIST','list\\b')
+    tok.add_token('MAYBE','maybe\\b')
+    tok.add_token('KEEP','keep\\b')
+    tok.add_token('QUOTE','"')
+    tok.add_token('SEMICOLON',';')
+    tok.add_comment_style('/\\*.*?\\*/',re.DOTALL)
+    tok.add_comment_style('#.*$',re.MULTILINE)
+
+    hex_tok = Tokenizer()
+    hex_tok.add_token('HEX','[0-9A-F][0-9A-F]',hex_character)
+
+    par = Parser()
+    par.add_rule('start',[(['statement+'],statements)],tokenizer=tok)
+    par.add_rule('statement',[
+        (['VALUE','!','add-term','SEMICOLON'],value_statement),
+        (['LIST','OPEN','NUMBER%%COMMA*','CLOSE','SEMICOLON'],list_statement),
+        (['MAYBE','NUMBER?','SEMICOLON'],optional_statement),
+        (['KEEP','OPEN','NUMBER%%[COMMA]*','CLOSE','SEMICOLON'],list_statement),
+        (['QUOTE','string','QUOTE'],string_statement),
+    ])
+    par.add_rule('add-term',[
+        (['NUMBER','PLUS','add-term'],add,{'pure':True}),
+        (['NUMBER'],first),
+    ])
+    par.add_rule('string',[(['HEX+'],join)],tokenizer=hex_tok)
+    return par
+
+def make_indent_parser():
+    "Python-like blocks"
+    tok = Tokenizer()
+    tok.add_token('BLOCK','block:')
+    tok.add_token('NUMBER','[0-9]+',number)
+    tok.use_indent_tokens('INDENT','OUTDENT',tabsize=4)
+
+    par = Parser()
+    par.add_rule('start',[(['statement+'],total)],tokenizer=tok)
+    par.add_rule('statement',[
+        (['BLOCK','INDENT','statement+','OUTDENT'],block),
+        (['NUMBER'],first),
+    ])
+    return par
+
+def flatten(tree):
+    "Everything about a tree that the generated parser must reproduce"
+    if isinstance(tree,list):
+        return ['[']+[item for child in tree for item in flatten(child)]+[']']
+    if isinstance(tree,Node):
+        return [(tree.rule,tree.walk_function,tree.memo)]+flatten(tree.children)
+    return [(tree.token,tree.body,tree.filename,tree.linenumber,tree.column,tree.walk_function,tree.memo)]
+
+def load(parser,tmp_path,name):
+    "Generate a parser module and import it"
+    filename = tmp_path / f"{name}.py"
+    parser.generate_module(str(filename))
+    spec = importlib.util.spec_from_file_location(name,filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+LANGUAGE_PROGRAM = """
+value 1 + 2 + 3;   # comment
+list [1, 2, 3,];
+/* multi-line
+   comment */
+maybe 4; maybe ;
+list [];
+keep [1, 2,]; keep [3];
+"48 65 6C"
+"""
+
+INDENT_PROGRAM = """
+block:
+    1
+    block:
+\t    2
+        3
+4
+"""
+
+def test_same_tree(tmp_path):
+    "The generated parser builds exactly the same tree as the interpreter"
+    parser = make_language_parser()
+    generated = load(parser,tmp_path,"language_parser")
+    tree = generated.parse(LANGUAGE_PROGRAM)
+    assert flatten(tree) == flatten(parser.parse(LANGUAGE_PROGRAM))
+    assert tree.walk() == [6,[1,2,3],[4],[],[],[1,",",2,","],[3],"Hel"]
+
+def test_same_tree_indents(tmp_path):
+    "Indent tokens work the same way in the generated parser"
+    parser = make_indent_parser()
+    generated = load(parser,tmp_path,"indent_parser")
+    assert flatten(generated.parse(INDENT_PROGRAM)) == flatten(parser.parse(INDENT_PROGRAM))
+    assert generated.parse(INDENT_PROGRAM).walk() == 10
+
+def test_same_tree_bytes(tmp_path):
+    "The generated parser also tokenizes bytes"
+    parser = make_language_parser()
+    generated = load(parser,tmp_path,"bytes_parser")
+    assert generated.parse(LANGUAGE_PROGRAM.encode('utf-8')).walk() == parser.parse(LANGUAGE_PROGRAM).walk()
+
+def test_same_failures(tmp_path):
+    "Bad input fails the same way"
+    parser = make_language_parser()
+    generated = load(parser,tmp_path,"failing_parser")
+    for program,exception in (("value 1 + ;",ParseCommitException),("list [1 2];",ParseFailException),("maybe 1; maybe",ParseFailException)):
+        with pytest.raises(exception) as generated_exc:
+            generated.parse(program)
+        with pytest.raises(exception) as interpreted_exc:
+            parser.parse(program)
+        assert str(generated_exc.value) == str(interpreted_exc.value)
+
+def test_lambda_walk_rejected(tmp_path):
+    "Walk functions that can't be imported by name can't be used"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','[0-9]+')
+    par = Parser()
+    par.add_rule('start',[(['NUMBER'],lambda a: a.walk())],tokenizer=tok)
+    with pytest.raises(ParseDefinitionException):
+        par.generate_module(str(tmp_path / "lambda_parser.py"))
+
+def test_public_imports_only(tmp_path):
+    "The generated module only imports oreo's public names, and only calls their public methods"
+    for name,parser in (('public_parser',make_language_parser()),('public_indent_parser',make_indent_parser())):
+        filename = tmp_path / f"{name}.py"
+        parser.generate_module(str(filename))
+        source = filename.read_text(encoding='utf-8')
+        imports = [line for line in source.splitlines() if line.startswith('from oreo import')]
+        assert imports and all('_' not in name for line in imports for name in line.split('import')[1].split(','))
+        assert 'import inspect' not in source
+        assert not re.search('_tokenizer_[0-9]+\\._',source)
@@ -0,0 +1,57 @@
+"""
+Test the commit marker '!' in rule patterns.
+"""
+import pytest
+from oreo import Tokenizer,Parser,Generator,ParseCommitException,ParseFailException
+
+@pytest.fixture(name="language_parser")
+def fixture_language_parser():
+    "Statements that commit once their keyword has matched"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','-?[0-9]+',lambda ctx,n: int(n))
+    tok.add_token('PLUS','\\+')
+    tok.add_token('EQUALS','=')
+    tok.add_token('VALUE','value\\b')
+    tok.add_token('SYMBOL','[a-z]+')
+    tok.add_token('SEMICOLON',';')
+
+    par = Parser()
+    par.add_rule('start',[(['statement+'],lambda ctx,a: [i.walk(ctx) for i in a])],tokenizer=tok)
+    par.add_rule('statement',[
+        (['VALUE','!','add-term','SEMICOLON'],lambda ctx,a,b,c: b.walk(ctx)),
+        (['SYMBOL','EQUALS','!','add-term','SEMICOLON'],lambda ctx,a,b,c,d: ctx.__setitem__(a.walk(ctx),c.walk(ctx))),
+    ])
+    par.add_rule('add-term',[
+        (['number-term','PLUS','add-term'],lambda ctx,a,b,c: a.walk(ctx)+c.walk(ctx)),
+        (['number-term'],lambda ctx,a: a.walk(ctx)),
+    ])
+    par.add_rule('number-term',[
+        (['NUMBER'],lambda ctx,a: a.walk(ctx)),
+        (['SYMBOL'],lambda ctx,a: ctx[a.walk(ctx)]),
+    ])
+    return par
+
+def test_commit_parses(language_parser):
+    "The commit marker isn't passed to the walk function"
+    assert language_parser.parse('a = 1; value a + 2;').walk({})[-1] == 3
+
+def test_commit_before_marker(language_parser):
+    "Failing before the marker still tries the next alternative"
+    assert language_parser.parse('valuex = 4; value valuex;').walk({})[-1] == 4
+
+def test_commit_error_location(language_parser):
+    "Failing after the marker stops the parse and reports where"
+    with pytest.raises(ParseCommitException) as exc:
+        language_parser.parse('a = 1;\nvalue 1 + ;\nvalue 2;')
+    assert 'expected SEMICOLON' in str(exc.value)
+    assert 'Input:1:' in str(exc.value)
+
+def test_commit_is_parse_failure(language_parser):
+    "A commit failure is still a ParseFailException"
+    with pytest.raises(ParseFailException):
+        language_parser.parse('a = ;')
+
+def test_commit_tools(language_parser):
+    "The analyzer and generator skip the marker"
+    assert language_parser.analyze()['undefined'] == []
+    language_parser.parse(Generator(language_parser,seed=1).generate())
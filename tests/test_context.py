@@ -3,7 +3,7 @@ Grammar for a language that supports variables.
 """
 import re
 import pytest
-from oreo import Tokenizer,Parser
+from oreo import Tokenizer,Parser,ParseFailException
 
 
 def set_value(ctx,symbol,walk):
@@ -87,3 +87,75 @@ def test_comments_multiline_style(language_parser):
         """
     context = {}
     assert (language_parser.parse(program).walk(context))[-1] == 8
+
+def test_comments_mmap(language_parser,tmp_path):
+    "Test comment styles when tokenizing a memory-mapped file"
+    program = """
+        a = 1 + 1; # This is a comment
+        /* And this is a
+         * multiline
+         * comment.
+         */
+        b = 2 * 3;
+        value a+b;
+        """
+    filename = tmp_path / "program.input"
+    filename.write_text(program,encoding='utf-8')
+    context = {}
+    assert (language_parser.parse_file(str(filename),mode="mmap").walk(context))[-1] == 8
+
+def test_empty_file_mmap(tmp_path):
+    "An empty file can't be mmapped, but still parses"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','[0-9]+')
+    par = Parser()
+    par.add_rule('start',[(['NUMBER*'],lambda a: len(a))],tokenizer=tok)
+    filename = tmp_path / "empty.input"
+    filename.write_text("",encoding='utf-8')
+    assert par.parse_file(str(filename),mode="mmap").walk() == 0
+
+def test_bytes_partial_character():
+    "A bytes pattern that would match part of a multi-byte character doesn't match"
+    tok = Tokenizer()
+    tok.add_token('C','.')
+    par = Parser()
+    par.add_rule('start',[(['C+'],lambda a: ''.join(i.walk() for i in a))],tokenizer=tok)
+    assert par.parse("aü").walk() == "aü"
+    with pytest.raises(ParseFailException):
+        par.parse("aü".encode('utf-8'))
+
+def test_bytes_whole_characters():
+    "Bytes patterns that match whole characters decode to the same values as str input"
+    tok = Tokenizer()
+    tok.add_token('WORD','[^ ]+')
+    par = Parser()
+    par.add_rule('start',[(['WORD+'],lambda a: [i.walk() for i in a])],tokenizer=tok)
+    assert par.parse("aü bé".encode('utf-8')).walk() == ["aü","bé"]
+
+@pytest.fixture(name="anchored_parser")
+def fixture_anchored_parser():
+    "Tokens and comments that look at the text before them"
+    tok = Tokenizer()
+    tok.add_token('WORD','^[a-z]+')
+    tok.add_token('NUMBER','\\b[0-9]+')
+    tok.add_token('AFTER','(?<![a-z])_')
+    tok.add_comment_style('^#[^\n]*')
+    par = Parser()
+    par.add_rule('start',[(['item+'],lambda a: [i.walk() for i in a])],tokenizer=tok)
+    par.add_rule('item',[(['WORD'],lambda a: a.walk()),(['NUMBER'],lambda a: a.walk()),(['AFTER'],lambda a: a.walk())])
+    return par
+
+def test_anchored_patterns(anchored_parser):
+    "^, a leading \\b and lookbehinds see the input as starting at the current token"
+    for text,expected in (("foo bar #note\nbaz",["foo","bar","baz"]),("foo1 _x",["foo","1","_","x"])):
+        assert anchored_parser.parse(text).walk() == expected
+        assert anchored_parser.parse(text.encode('utf-8')).walk() == expected
+
+def test_anchored_patterns_mmap(anchored_parser,tmp_path):
+    "Anchored patterns work on a memory-mapped file, which can still be closed after a failure"
+    filename = tmp_path / "anchored.input"
+    filename.write_text("foo1 _x",encoding='utf-8')
+    assert anchored_parser.parse_file(str(filename),mode="mmap").walk() == ["foo","1","_","x"]
+    filename.write_text("foo1 ?",encoding='utf-8')
+    with pytest.raises(ParseFailException):
+        anchored_parser.parse_file(str(filename),mode="mmap")
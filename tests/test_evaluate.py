@@ -0,0 +1,60 @@
+"""
+Test evaluating input directly while parsing, without building a tree.
+"""
+import pytest
+from oreo import Tokenizer,Parser,ParseFailException
+
+@pytest.fixture(name="calculator")
+def fixture_calculator():
+    "Arithmetic grammar whose walk functions take values rather than Nodes"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','-?[0-9]+',lambda ctx,n: int(n))
+    tok.add_token('SYMBOL','[a-z]+')
+    tok.add_token('PLUS','\\+')
+    tok.add_token('MINUS','-')
+    tok.add_token('MULTIPLY','\\*')
+    tok.add_token('OPEN_PAREN','\\(')
+    tok.add_token('CLOSE_PAREN','\\)')
+    tok.add_token('EQUALS','=')
+    tok.add_token('SEMICOLON',';')
+
+    par = Parser()
+    par.add_rule('start',[(['statement+'],lambda ctx,a: a[-1])],tokenizer=tok)
+    par.add_rule('statement',[
+        (['SYMBOL','EQUALS','add-term','SEMICOLON'],lambda ctx,a,b,c,d: ctx.__setitem__(a,c) or c),
+        (['add-term','SEMICOLON'],lambda ctx,a,b: a),
+    ])
+    par.add_rule('add-term',[
+        (['mult-term','PLUS','add-term'],lambda ctx,a,b,c: a+c),
+        (['mult-term','MINUS','add-term'],lambda ctx,a,b,c: a-c),
+        (['mult-term'],lambda ctx,a: a),
+    ])
+    par.add_rule('mult-term',[
+        (['number-term','MULTIPLY','mult-term'],lambda ctx,a,b,c: a*c),
+        (['number-term'],lambda ctx,a: a),
+    ])
+    par.add_rule('number-term',[
+        (['OPEN_PAREN','add-term','CLOSE_PAREN'],lambda ctx,a,b,c: b),
+        (['NUMBER'],lambda ctx,a: a),
+        (['SYMBOL'],lambda ctx,a: ctx[a]),
+    ])
+    return par
+
+def test_evaluate(calculator):
+    "Values are computed bottom-up while parsing"
+    assert calculator.evaluate('(2 + 1) * 3 - 4;',{}) == 5
+
+def test_evaluate_context(calculator):
+    "The context is passed to every walk function"
+    context = {}
+    assert calculator.evaluate('a = 2; b = a * 3; a + b;',context) == 8
+    assert context == {'a':2,'b':6}
+
+def test_evaluate_backtracking(calculator):
+    "Values from abandoned alternatives don't leak into the result"
+    assert calculator.evaluate('1 * 2 * 3 - 2 * 2 + 1;',{}) == 1
+
+def test_evaluate_failure(calculator):
+    "Bad input fails the same way as parse()"
+    with pytest.raises(ParseFailException):
+        calculator.evaluate('1 + ;',{})
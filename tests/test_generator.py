@@ -0,0 +1,86 @@
+"""
+Test generating random input from a grammar.
+"""
+import pytest
+from oreo import Tokenizer,Parser,Generator,ParseDefinitionException
+
+@pytest.fixture(name="statement_parser")
+def fixture_statement_parser():
+    "Statements with nested expressions"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','-?[0-9]+',int)
+    tok.add_token('SYMBOL','[a-z]+')
+    tok.add_token('PLUS','\\+')
+    tok.add_token('EQUALS','=')
+    tok.add_token('OPEN_PAREN','\\(')
+    tok.add_token('CLOSE_PAREN','\\)')
+    tok.add_token('SEMICOLON',';')
+
+    par = Parser()
+    par.add_rule('start',[(['statement+'],lambda a: len(a))],tokenizer=tok)
+    par.add_rule('statement',[(['SYMBOL','EQUALS','expression','SEMICOLON'],lambda a,b,c,d: c)])
+    par.add_rule('expression',[
+        (['term','PLUS','expression'],lambda a,b,c: a),
+        (['term'],lambda a: a),
+    ])
+    par.add_rule('term',[
+        (['OPEN_PAREN','expression','CLOSE_PAREN'],lambda a,b,c: b),
+        (['NUMBER'],lambda a: a),
+    ])
+    return par
+
+@pytest.fixture(name="block_parser")
+def fixture_block_parser():
+    "Python-like nested blocks"
+    tok = Tokenizer()
+    tok.add_token('BLOCK','block:')
+    tok.add_token('SYMBOL','[a-z]+')
+    tok.use_indent_tokens('INDENT','OUTDENT')
+
+    par = Parser()
+    par.add_rule('start',[(['statement+'],lambda a: len(a))],tokenizer=tok)
+    par.add_rule('statement',[
+        (['BLOCK','INDENT','statement+','OUTDENT'],lambda a,b,c,d: c),
+        (['SYMBOL'],lambda a: a),
+    ])
+    return par
+
+def test_generated_input_parses(statement_parser):
+    "Generated input is accepted by the parser"
+    generator = Generator(statement_parser,seed=1)
+    for _ in range(10):
+        statement_parser.parse(generator.generate())
+
+def test_reproducible(statement_parser):
+    "The same seed generates the same inputs"
+    first = Generator(statement_parser,seed=42)
+    second = Generator(statement_parser,seed=42)
+    assert [first.generate() for _ in range(5)] == [second.generate() for _ in range(5)]
+
+def test_size(statement_parser):
+    "Inputs can be generated to a target size"
+    text = Generator(statement_parser,seed=3).generate(size=5000)
+    assert len(text) >= 5000
+    assert statement_parser.parse(text).walk() > 100
+
+def test_depth(statement_parser):
+    "Nesting stops at max_depth"
+    text = Generator(statement_parser,seed=7,max_depth=3,max_repeat=10).generate()
+    assert '(' not in text
+
+def test_indents(block_parser):
+    "Indent and outdent tokens are laid out as indented lines"
+    generator = Generator(block_parser,seed=5,max_depth=4)
+    texts = [generator.generate() for _ in range(10)]
+    assert any("\n    " in text for text in texts)
+    for text in texts:
+        block_parser.parse(text)
+
+def test_no_finite_input():
+    "A grammar that can only recurse forever can't generate anything"
+    tok = Tokenizer()
+    tok.add_token('X','x')
+    par = Parser()
+    par.add_rule('start',[(['X','start'],lambda a,b: a)],tokenizer=tok)
+    with pytest.raises(ParseDefinitionException):
+        Generator(par,seed=1,max_depth=2).generate()
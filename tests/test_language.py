@@ -120,3 +120,25 @@ def test_parsefile(language_parser):
     ctx = {}
     assert language_parser.parse_file("tests/test_language/1.input").walk(ctx) == 8
     language_parser.parse_file("tests/test_language/1.input").dump()
+
+def test_parsefile_mmap(language_parser):
+    "Test program memory-mapped from a file and tokenized as bytes"
+    ctx = {}
+    assert language_parser.parse_file("tests/test_language/1.input",mode="mmap").walk(ctx) == 8
+
+def test_parsefile_mmap_token_body(language_parser):
+    "Token bodies from an mmapped file are plain strings"
+    tree = language_parser.parse_file("tests/test_language/1.input",mode="mmap")
+    symbol = tree.children[0][0].children[0]
+    assert symbol.body == "count"
+    assert isinstance(symbol.body,str)
+
+def test_parsefile_bad_mode(language_parser):
+    "Unknown parse_file modes are rejected"
+    with pytest.raises(ValueError):
+        language_parser.parse_file("tests/test_language/1.input",mode="bogus")
+
+def test_analyze_keywords(language_parser):
+    "Statements starting with a keyword conflict with the assignment, whose SYMBOL also matches keywords"
+    conflicts = [conflict for conflict in language_parser.analyze()['first_conflicts'] if conflict[0] == 'statement']
+    assert {conflict[3] for conflict in conflicts} == {('PRINT','SYMBOL'),('IF','SYMBOL'),('SYMBOL','WHILE')}
@@ -0,0 +1,61 @@
+"""
+Test caching of walk() results for alternatives declared pure or context-dependent.
+"""
+import pytest
+from oreo import Tokenizer,Parser,ParseDefinitionException
+
+@pytest.fixture(name="counting_parser")
+def fixture_counting_parser():
+    "Grammar whose walk() functions count how often they are called"
+    calls = {'constant':0,'symbol':0,'number':0}
+
+    def constant(ctx,_,a):
+        calls['constant'] += 1
+        return a.walk(ctx)
+
+    def symbol(ctx,_,a):
+        calls['symbol'] += 1
+        return ctx[a.walk(ctx)]
+
+    def number(ctx,n):
+        calls['number'] += 1
+        return int(n)
+
+    tok = Tokenizer()
+    tok.add_token('NUMBER','[0-9]+',number,pure=True)
+    tok.add_token('SYMBOL','[a-z]+')
+    tok.add_token('PLUS','\\+')
+
+    par = Parser()
+    par.add_rule('start',[(['term+'],lambda ctx,a: sum(i.walk(ctx) for i in a))],tokenizer=tok)
+    par.add_rule('term',[
+        (['PLUS','NUMBER'],constant,{'pure':True}),
+        (['PLUS','SYMBOL'],symbol,{'depends':['x']}),
+    ])
+
+    return par,calls
+
+def test_pure_cached(counting_parser):
+    "Pure walk() results are computed once per node"
+    par,calls = counting_parser
+    tree = par.parse('+ 1 + 2 + x')
+    assert tree.walk({'x':10}) == 13
+    assert tree.walk({'x':10}) == 13
+    assert calls['constant'] == 2
+    assert calls['number'] == 2
+
+def test_depends_invalidated(counting_parser):
+    "Results that depend on context keys are recomputed only when those keys change"
+    par,calls = counting_parser
+    tree = par.parse('+ x + x')
+    assert tree.walk({'x':1,'y':1}) == 2
+    assert tree.walk({'x':1,'y':2}) == 2
+    assert calls['symbol'] == 2
+    assert tree.walk({'x':5,'y':2}) == 10
+    assert calls['symbol'] == 4
+
+def test_bad_option():
+    "Unknown alternative options are rejected"
+    par = Parser()
+    with pytest.raises(ParseDefinitionException):
+        par.add_rule('start',[(['NUMBER'],lambda a: a.walk(),{'cached':True})])
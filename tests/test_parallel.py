@@ -0,0 +1,118 @@
+"""
+Test parsing a single input in parallel chunks.
+"""
+import re
+import threading
+import pytest
+import oreo
+from oreo import Tokenizer,Parser,Node,ParseFailException,ParseDefinitionException
+
+def flatten(tree):
+    "List every token in a tree with its location"
+    if isinstance(tree,list):
+        return [token for child in tree for token in flatten(child)]
+    if isinstance(tree,Node):
+        return [(tree.rule,)]+flatten(tree.children)
+    return [(tree.token,tree.body,tree.linenumber,tree.column)]
+
+@pytest.fixture(name="statement_parser")
+def fixture_statement_parser():
+    "Statements terminated by semicolons"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','-?[0-9]+',int)
+    tok.add_token('SYMBOL','[a-z]+')
+    tok.add_token('PLUS','\\+')
+    tok.add_token('EQUALS','=')
+    tok.add_token('SEMICOLON',';')
+    tok.add_comment_style('/\\*.*?\\*/',re.DOTALL)
+    tok.add_comment_style('#[^\n]*')
+
+    par = Parser()
+    par.add_rule('start',[(['statement+'],lambda a: sum(i.walk() for i in a))],tokenizer=tok)
+    par.add_rule('statement',[(['SYMBOL','EQUALS','expression','SEMICOLON'],lambda a,b,c,d: c.walk())])
+    par.add_rule('expression',[
+        (['NUMBER','PLUS','expression'],lambda a,b,c: a.walk()+c.walk()),
+        (['NUMBER'],lambda a: a.walk()),
+    ])
+    return par
+
+@pytest.fixture(name="block_parser")
+def fixture_block_parser():
+    "Python-like nested blocks"
+    tok = Tokenizer()
+    tok.add_token('BLOCK','block:')
+    tok.add_token('NUMBER','[0-9]+',int)
+    tok.use_indent_tokens('INDENT','OUTDENT')
+
+    par = Parser()
+    par.add_rule('start',[(['statement+'],lambda a: sum(i.walk() for i in a))],tokenizer=tok)
+    par.add_rule('statement',[
+        (['BLOCK','INDENT','statement+','OUTDENT'],lambda a,b,c,d: sum(i.walk() for i in c)),
+        (['NUMBER'],lambda a: a.walk()),
+    ])
+    return par
+
+def test_split_at_token(statement_parser):
+    "Chunks split after a terminator give the same tree as a serial parse"
+    program = "".join(f"x = {i} + 1;\n" for i in range(300))
+    serial = statement_parser.parse(program)
+    parallel = statement_parser.parse(program,workers=2,split_at='SEMICOLON')
+    assert parallel.walk() == serial.walk() == sum(i+1 for i in range(300))
+    assert flatten(parallel) == flatten(serial)
+
+def test_split_at_indent(block_parser):
+    "Indent grammars are split at unindented lines"
+    program = "".join(f"block:\n    {i}\n    block:\n        1\n" for i in range(200))
+    serial = block_parser.parse(program)
+    parallel = block_parser.parse(program,workers=3)
+    assert parallel.walk() == serial.walk()
+    assert flatten(parallel) == flatten(serial)
+
+def test_boundary_mismatch(statement_parser):
+    "Chunks cut inside a comment fall back to a serial parse"
+    program = "".join(f"x = {i};\n/* ;;;;;;;;;;\n;;;;;;;;;; */\n" for i in range(100))
+    serial = statement_parser.parse(program)
+    parallel = statement_parser.parse(program,workers=2,split_at='SEMICOLON')
+    assert flatten(parallel) == flatten(serial)
+
+def test_line_comment_boundary(statement_parser):
+    "A cut after a split_at token inside a line comment is rejected, even if both sides parse"
+    for line in ("x = {i}; # note; y = 99;\n","x = {i}; # note; y = 99; end\n"):
+        program = "".join(line.format(i=i) for i in range(50))
+        serial = statement_parser.parse(program)
+        parallel = statement_parser.parse(program,workers=2,split_at='SEMICOLON')
+        assert len(parallel.children[0]) == 50
+        assert flatten(parallel) == flatten(serial)
+
+def test_parallel_failure(statement_parser):
+    "Bad input still fails"
+    program = "".join(f"x = {i};\n" for i in range(100))+"x = ;\n"
+    with pytest.raises(ParseFailException):
+        statement_parser.parse(program,workers=2,split_at='SEMICOLON')
+
+def test_needs_list_start(statement_parser):
+    "The start rule must be a single repeated item, and split_at must be a token"
+    with pytest.raises(ParseDefinitionException):
+        statement_parser.parse("x = 1;",workers=2)
+    with pytest.raises(ParseDefinitionException):
+        statement_parser.parse("x = 1;",workers=2,split_at='COMMA')
+
+def test_parallel_mmap(statement_parser,tmp_path):
+    "A memory-mapped file can be parsed in parallel"
+    program = "".join(f"x = {i} + 1;\n" for i in range(300))
+    filename = tmp_path / "program.input"
+    filename.write_text(program,encoding='utf-8')
+    parallel = statement_parser.parse_file(str(filename),mode="mmap",workers=2,split_at='SEMICOLON')
+    assert flatten(parallel) == flatten(statement_parser.parse(program))
+
+def test_parallel_from_thread(statement_parser,monkeypatch):
+    "Workers aren't forked from a process that is running other threads"
+    def no_fork(*args,**kwargs):
+        raise AssertionError("forked a multi-threaded process")
+    monkeypatch.setattr(oreo,'ProcessPoolExecutor',no_fork)
+    program = "".join(f"x = {i} + 1;\n" for i in range(100))
+    results = []
+    thread = threading.Thread(target=lambda: results.append(statement_parser.parse(program,workers=2,split_at='SEMICOLON').walk()))
+    thread.start()
+    thread.join()
+    assert results == [sum(i+1 for i in range(100))]
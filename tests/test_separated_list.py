@@ -0,0 +1,80 @@
+"""
+Test separated lists, e.g. item%COMMA+
+"""
+import pytest
+from oreo import Tokenizer,Parser,Generator,ParseFailException,ParseDefinitionException
+
+@pytest.fixture(name="list_parser")
+def fixture_list_parser():
+    "Bracketed lists of numbers"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','-?[0-9]+',int)
+    tok.add_token('COMMA',',')
+    tok.add_token('OPEN','\\[')
+    tok.add_token('CLOSE','\\]')
+    tok.add_token('STRICT','strict')
+    tok.add_token('EMPTY','empty')
+    tok.add_token('TRAILING','trailing')
+    tok.add_token('KEEP','keep')
+
+    par = Parser()
+    par.add_rule('start',[
+        (['STRICT','OPEN','NUMBER%COMMA+','CLOSE'],lambda a,b,c,d: [i.walk() for i in c]),
+        (['EMPTY','OPEN','NUMBER%COMMA*','CLOSE'],lambda a,b,c,d: [i.walk() for i in c]),
+        (['TRAILING','OPEN','NUMBER%%COMMA+','CLOSE'],lambda a,b,c,d: [i.walk() for i in c]),
+        (['KEEP','OPEN','NUMBER%[COMMA]*','CLOSE'],lambda a,b,c,d: [i.walk() for i in c]),
+        (['KEEP','TRAILING','OPEN','NUMBER%%[COMMA]+','CLOSE'],lambda a,b,c,d,e: [i.walk() for i in d]),
+    ],tokenizer=tok)
+    return par
+
+def test_separated(list_parser):
+    "Separators are dropped from the list of items"
+    assert list_parser.parse('strict [1, 2, 3]').walk() == [1,2,3]
+
+def test_separated_single(list_parser):
+    "A single item has no separator"
+    assert list_parser.parse('strict [1]').walk() == [1]
+
+def test_separated_empty(list_parser):
+    "Lists with * can be empty"
+    assert list_parser.parse('empty []').walk() == []
+    with pytest.raises(ParseFailException):
+        list_parser.parse('strict []')
+
+def test_trailing_separator(list_parser):
+    "Trailing separators are only allowed with %%"
+    assert list_parser.parse('trailing [1, 2,]').walk() == [1,2]
+    assert list_parser.parse('trailing [1, 2]').walk() == [1,2]
+    with pytest.raises(ParseFailException):
+        list_parser.parse('strict [1, 2,]')
+
+def test_keep_separators(list_parser):
+    "Separators in brackets are kept in the list, between the items"
+    assert list_parser.parse('keep [1, 2, 3]').walk() == [1,',',2,',',3]
+    assert list_parser.parse('keep []').walk() == []
+    assert list_parser.parse('keep trailing [1, 2,]').walk() == [1,',',2,',']
+    assert list_parser.parse('keep trailing [1]').walk() == [1]
+    with pytest.raises(ParseFailException):
+        list_parser.parse('keep [1, 2,]')
+
+def test_long_list(list_parser):
+    "Long lists don't use up the stack"
+    numbers = list(range(20000))
+    assert list_parser.parse('strict ['+', '.join(str(i) for i in numbers)+']').walk() == numbers
+
+def test_separated_tools(list_parser):
+    "The analyzer and generator understand separated lists"
+    assert list_parser.analyze()['undefined'] == []
+    generator = Generator(list_parser,seed=2)
+    for _ in range(5):
+        list_parser.parse(generator.generate())
+
+def test_separated_modifier():
+    "Separated lists must be + or *"
+    tok = Tokenizer()
+    tok.add_token('NUMBER','[0-9]+')
+    tok.add_token('COMMA',',')
+    par = Parser()
+    par.add_rule('start',[(['NUMBER%COMMA?'],lambda a: a)],tokenizer=tok)
+    with pytest.raises(ParseDefinitionException):
+        par.parse('1')
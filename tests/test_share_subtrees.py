@@ -0,0 +1,132 @@
+"""
+Test parsing with share_subtrees, where identical subtrees are only built once
+"""
+import pytest
+from oreo import Tokenizer,Parser,SharedSubtrees,Token,ParseDefinitionException
+
+@pytest.fixture(name="config_parser")
+def fixture_config_parser():
+    "Blocks of settings; a block that starts with a setting and fails forces a backtrack"
+    calls = {'block':0}
+
+    def block(a,b,c,d):
+        calls['block'] += 1
+        return (a.walk(),[setting.walk() for setting in c])
+
+    tok = Tokenizer()
+    tok.add_token('OPEN','\\{')
+    tok.add_token('CLOSE','\\}')
+    tok.add_token('EQUALS','=')
+    tok.add_token('SEMICOLON',';')
+    tok.add_token('NUMBER','[0-9]+',int)
+    tok.add_token('SYMBOL','[a-z]+')
+
+    par = Parser()
+    par.add_rule('start',[(['item+'],lambda a: [i.walk() for i in a])],tokenizer=tok)
+    par.add_rule('item',[
+        (['SYMBOL','EQUALS','SYMBOL','SEMICOLON'],lambda a,b,c,d: (a.walk(),c.walk())),
+        (['block'],lambda a: a.walk()),
+    ])
+    par.add_rule('block',[(['SYMBOL','OPEN','setting*','CLOSE'],block,{'pure':True})])
+    par.add_rule('setting',[(['SYMBOL','EQUALS','NUMBER','SEMICOLON'],lambda a,b,c,d: (a.walk(),c.walk()))])
+    return par,calls
+
+CONFIG = """
+server { port = 80; timeout = 30; }
+name = main;
+server { port = 80; timeout = 30; }
+server { port = 8080; timeout = 30; }
+"""
+
+def objects(tree) -> set:
+    "The ids of every distinct Node and Token in tree"
+    seen = set()
+    pending = [tree]
+    while pending:
+        item = pending.pop()
+        if isinstance(item,list):
+            pending.extend(item)
+        elif id(item) not in seen:
+            seen.add(id(item))
+            if not isinstance(item,Token):
+                pending.extend(item.children)
+    return seen
+
+def test_same_result(config_parser):
+    "Sharing subtrees doesn't change what the tree walks to"
+    par,_ = config_parser
+    assert par.parse(CONFIG,share_subtrees=True).walk() == par.parse(CONFIG).walk()
+
+def test_subtrees_shared(config_parser):
+    "Identical blocks are the same Node, and repeated tokens the same Token"
+    par,_ = config_parser
+    items = par.parse(CONFIG,share_subtrees=True).children[0]
+    assert items[0] is items[2]
+    assert items[0] is not items[3]
+    first,last = items[0].children[0].children[2],items[3].children[0].children[2]
+    assert first[1] is last[1]
+    assert len(objects(items)) < len(objects(par.parse(CONFIG).children[0]))/2
+
+def test_large_input(config_parser):
+    "Repetitive inputs only keep one copy of each distinct subtree"
+    par,_ = config_parser
+    tree = par.parse(CONFIG*500,share_subtrees=True)
+    assert len(objects(tree)) == len(objects(par.parse(CONFIG,share_subtrees=True)))
+
+def test_locations(config_parser):
+    "The table records where each occurrence of a shared Token is, without tokens from abandoned alternatives"
+    par,_ = config_parser
+    shared = SharedSubtrees()
+    items = par.parse(CONFIG,filename='config',share_subtrees=shared).children[0]
+    server = items[0].children[0].children[0]
+    assert server.linenumber == 1
+    assert shared.locations[server] == [('config',1,0),('config',3,0),('config',4,0)]
+    port = items[3].children[0].children[2][0].children[2]
+    assert shared.locations[port] == [('config',4,16)]
+    assert sum(len(found) for found in shared.locations.values()) == 37
+
+def test_default_table(config_parser):
+    "share_subtrees=True makes a table that tracks locations, returned with the tree"
+    par,_ = config_parser
+    tree = par.parse(CONFIG,filename='config',share_subtrees=True)
+    server = tree.children[0][0].children[0].children[0]
+    assert isinstance(tree.shared,SharedSubtrees)
+    assert tree.shared.locations[server] == [('config',1,0),('config',3,0),('config',4,0)]
+
+def test_shared_table(config_parser):
+    "Two parses with the same table share everything that didn't change, so they can be compared by identity"
+    par,_ = config_parser
+    shared = SharedSubtrees()
+    old = par.parse(CONFIG,share_subtrees=shared).children[0]
+    new = par.parse(CONFIG.replace('8080','8081'),share_subtrees=shared).children[0]
+    assert [a is b for a,b in zip(old,new)] == [True,True,True,False]
+    assert par.parse(CONFIG,share_subtrees=shared).children[0][3] is old[3]
+
+def test_str_and_bytes(config_parser):
+    "Tokens are shared by their utf-8 text, so str and bytes parses share a table without decoding tokens"
+    par,_ = config_parser
+    shared = SharedSubtrees()
+    binary = par.parse(CONFIG.encode('utf-8'),share_subtrees=shared).children[0]
+    assert all(isinstance(token._body,bytes) for token in shared.locations)
+    text = par.parse(CONFIG,share_subtrees=shared).children[0]
+    assert all(a is b for a,b in zip(text,binary))
+
+def test_no_locations(config_parser):
+    "Occurrences aren't collected unless the table's locations are wanted"
+    par,_ = config_parser
+    shared = SharedSubtrees(track_locations=False)
+    items = par.parse(CONFIG,share_subtrees=shared).children[0]
+    assert items[0] is items[2]
+    assert shared.locations == {}
+
+def test_walk_cached(config_parser):
+    "Pure walk() results are computed once per shared subtree"
+    par,calls = config_parser
+    par.parse(CONFIG*100,share_subtrees=True).walk()
+    assert calls['block'] == 2
+
+def test_no_workers(config_parser):
+    "share_subtrees can't be combined with parallel parsing"
+    par,_ = config_parser
+    with pytest.raises(ParseDefinitionException):
+        par.parse(CONFIG,workers=2,share_subtrees=True)
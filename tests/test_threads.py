@@ -0,0 +1,95 @@
+"""
+Test sharing one frozen Parser between many threads.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import random
+import pytest
+from oreo import Tokenizer,Parser,ParseDefinitionException,ParseFailException
+
+OPERATORS = {'+':lambda a,b: a+b,'-':lambda a,b: a-b,'*':lambda a,b: a*b}
+
+def apply_operators(first,rest):
+    "Apply a list of (operator,operand) tails from left to right"
+    value = first.walk()
+    for tail in rest:
+        operator,operand = tail.walk()
+        value = OPERATORS[operator](value,operand)
+    return value
+
+@pytest.fixture(name="arithmetic_parser")
+def fixture_arithmetic_parser():
+    """
+    Grammar for simple arithmetic expressions, frozen so it can be shared.  Operators are
+    repeated tails rather than right recursion, so nested parentheses don't backtrack exponentially.
+    """
+    tok = Tokenizer()
+    tok.add_token('NUMBER','-?[0-9]+',int)
+    tok.add_token('PLUS','\\+')
+    tok.add_token('MINUS','-')
+    tok.add_token('MULTIPLY','\\*')
+    tok.add_token('OPEN_PAREN','\\(')
+    tok.add_token('CLOSE_PAREN','\\)')
+    tok.use_indent_tokens('INDENT','OUTDENT')
+
+    par = Parser()
+    par.add_rule('start',[(['add-term'], lambda a: a.walk())],tokenizer=tok)
+    par.add_rule('add-term',[(['mult-term','add-tail*'], apply_operators)])
+    par.add_rule('add-tail',[
+        (['PLUS','mult-term'], lambda a,b: ('+',b.walk())),
+        (['MINUS','mult-term'], lambda a,b: ('-',b.walk())),
+    ])
+    par.add_rule('mult-term',[(['number-term','mult-tail*'], apply_operators)])
+    par.add_rule('mult-tail',[(['MULTIPLY','number-term'], lambda a,b: ('*',b.walk()))])
+    par.add_rule('number-term',[
+        (['OPEN_PAREN','add-term','CLOSE_PAREN'], lambda a,b,c: b.walk()),
+        (['INDENT','add-term','OUTDENT'], lambda a,b,c: b.walk()),
+        (['NUMBER'], lambda a: a.walk()),
+    ])
+
+    return par.freeze()
+
+def random_expression(rng,depth=0):
+    "Build a random expression, up to 6 levels of parentheses deep, and its value"
+    if depth >= 6 or rng.random() < 0.2:
+        value = rng.randint(0,9)
+        return str(value),value
+    left,left_value = random_expression(rng,depth+1)
+    right,right_value = random_expression(rng,depth+1)
+    operator = rng.choice('+-*')
+    value = OPERATORS[operator](left_value,right_value)
+    return f"({left} {operator} {right})",value
+
+def test_frozen_grammar(arithmetic_parser):
+    "A frozen grammar can't be changed"
+    with pytest.raises(ParseDefinitionException):
+        arithmetic_parser.add_rule('extra',[(['NUMBER'],lambda a: a.walk())])
+    with pytest.raises(ParseDefinitionException):
+        arithmetic_parser.rules['start']['tokenizer'].add_token('EXTRA','extra')
+
+def test_concurrent_parses(arithmetic_parser):
+    "Many threads parsing different inputs with one Parser all get the right answers"
+    rng = random.Random(1234)
+    cases = [random_expression(rng) for _ in range(500)]
+    assert max(text.count('(') for text,_ in cases) > 20
+    cases += [("\n1 +\n    2 *\n        3\n",7)]*50
+
+    def parse_and_walk(case):
+        text,_ = case
+        return arithmetic_parser.parse(text).walk()
+
+    with ThreadPoolExecutor(max_workers=16) as pool:
+        results = list(pool.map(parse_and_walk,cases))
+    assert results == [value for _,value in cases]
+
+def test_concurrent_failures(arithmetic_parser):
+    "Failing parses in some threads don't disturb the others"
+    def parse_and_walk(index):
+        if index % 2:
+            with pytest.raises(ParseFailException):
+                arithmetic_parser.parse("(1 + 2")
+            return None
+        return arithmetic_parser.parse(f"{index} * 2").walk()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(parse_and_walk,range(200)))
+    assert results == [index*2 if index % 2 == 0 else None for index in range(200)]